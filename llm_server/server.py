@@ -18,6 +18,7 @@ os.environ["HF_DATASETS_OFFLINE"] = "1"
 os.environ["HF_EVALUATE_OFFLINE"] = "1"
 
 import argparse
+import json
 import time
 import uuid
 from typing import List, Optional
@@ -26,6 +27,7 @@ import torch
 import uvicorn
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
@@ -238,6 +240,13 @@ def chat_completions(request: ChatCompletionRequest):
         response_text = _tokenizer.decode(new_tokens, skip_special_tokens=True)
         completion_tokens = len(new_tokens)
 
+        if request.stream:
+            # OpenAI clients read stream=True responses as server-sent events; the text
+            # is generated in one pass, so it is sent as a single chunk
+            return StreamingResponse(
+                _sse_chunks(response_text), media_type="text/event-stream"
+            )
+
         return ChatCompletionResponse(
             model=_model_name,
             choices=[
@@ -259,6 +268,22 @@ def chat_completions(request: ChatCompletionRequest):
         raise HTTPException(status_code=500, detail=f"Generation error: {str(e)}")
 
 
+def _sse_chunks(text: str):
+    """chat.completion.chunk events carrying the whole text, then [DONE]."""
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+    created = int(time.time())
+    for delta, finish_reason in (({"role": "assistant", "content": text}, None), ({}, "stop")):
+        chunk = {
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": _model_name,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
 @app.get("/health")
 def health():
     """Simple health check endpoint."""
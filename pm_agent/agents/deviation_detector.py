@@ -1,8 +1,13 @@
 import pandas as pd
 import numpy as np
-import pm4py
+import scipy.stats
+import sys
+from collections import Counter
 from typing import Dict, Any, Tuple, List
 
+# Стандартные имена колонок pm4py, в которые переименовываются выбранные роли
+_PM4PY_RESERVED = frozenset({'case:concept:name', 'concept:name', 'time:timestamp'})
+
 
 class DeviationDetectorAgent:
     """
@@ -15,18 +20,36 @@ class DeviationDetectorAgent:
         self.activity_col = activity_col
         self.timestamp_col = timestamp_col
         self.quality_report = {}
+        # Кэш частот вариантов (привязан к конкретному логу)
+        self._variants = None
+        self._variants_key = None
+        # Имена для кодов 'case_code' / 'act_code', которые _add_durations добавляет в лог
+        self._case_names = None
+        self._act_names = None
 
     def preprocess_event_log(self, df: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, Any]]:
         # 0. ИЗОЛЯЦИЯ: Гарантируем чистый Pandas (CPU) для стабильности на Linux
         if hasattr(df, 'to_pandas'):
             df = df.to_pandas()
-        else:
+        elif 'cudf.pandas' in sys.modules:
             # Если активен cudf.pandas, разрываем связь через dict
             df = pd.DataFrame(df.to_dict('list'))
+        else:
+            # Обычный pandas: поверхностная копия вместо поэлементной пересборки через dict.
+            # Колонки ниже только переприсваиваются целиком, исходный df не меняется
+            df = df.copy(deep=False)
+
+        # Колонки со стандартными именами pm4py, не выбранные как роли, дали бы дубли
+        # после переименования — удаляем их одним вызовом (как это делает pm4py.format_dataframe)
+        conflicting = _PM4PY_RESERVED.intersection(df.columns).difference(
+            (self.case_col, self.activity_col, self.timestamp_col)
+        )
+        if conflicting:
+            df = df.drop(columns=list(conflicting))
 
         self.quality_report = {
             'original_rows': len(df),
-            'original_cases': df[self.case_col].nunique() if self.case_col in df.columns else 0,
+            'original_cases': self._count_unique(df[self.case_col]) if self.case_col in df.columns else 0,
             'warnings': []
         }
 
@@ -40,12 +63,19 @@ class DeviationDetectorAgent:
             df = df.dropna(subset=[self.timestamp_col])
 
             # 1.3 CRITICAL: Convert to pydatetime BEFORE format_dataframe (Секрет старой версии)
-            df[self.timestamp_col] = [
-                t.to_pydatetime() if hasattr(t, 'to_pydatetime') else t 
-                for t in df[self.timestamp_col]
-            ]
+            if 'cudf.pandas' in sys.modules or not pd.api.types.is_datetime64_any_dtype(df[self.timestamp_col]):
+                df[self.timestamp_col] = [
+                    t.to_pydatetime() if hasattr(t, 'to_pydatetime') else t 
+                    for t in df[self.timestamp_col]
+                ]
+            else:
+                # Обычный pandas: тот же результат одной векторной операцией —
+                # pydatetime отбрасывает наносекунды, колонка снова выводится как datetime64
+                df[self.timestamp_col] = df[self.timestamp_col].dt.floor('us')
 
             # 1.4 ИСПОЛЬЗУЕМ ФОРМАТИРОВАНИЕ PM4PY НА УЖЕ ОЧИЩЕННЫХ ТИПАХ
+            # (pm4py импортируется здесь: импорт занимает ~2 с и не нужен при возобновлении сессии)
+            import pm4py
             df = pm4py.format_dataframe(
                 df, 
                 case_id=self.case_col, 
@@ -73,12 +103,18 @@ class DeviationDetectorAgent:
         df = df.drop_duplicates(subset=['case:concept:name', 'concept:name', 'time:timestamp'])
         
         self.quality_report['clean_rows'] = len(df)
-        self.quality_report['clean_cases'] = df['case:concept:name'].nunique()
-        self.quality_report['unique_activities'] = df['concept:name'].nunique()
+        self.quality_report['clean_cases'] = self._count_unique(df['case:concept:name'])
+        self.quality_report['unique_activities'] = self._count_unique(df['concept:name'])
         
-        # Безопасный расчет диапазона
-        ts_series = pd.to_datetime(df['time:timestamp'])
-        self.quality_report['date_range'] = (ts_series.min(), ts_series.max())
+        # Безопасный расчет диапазона: min/max по int64-наносекундам без NaT
+        ts_series = self._as_datetime(df['time:timestamp'])
+        ts_values = self._datetime_values(ts_series)
+        ts_ns = ts_values[~np.isnat(ts_values)].view('i8')
+        if ts_ns.size:
+            tz = ts_series.dt.tz
+            self.quality_report['date_range'] = (pd.Timestamp(ts_ns.min(), tz=tz), pd.Timestamp(ts_ns.max(), tz=tz))
+        else:
+            self.quality_report['date_range'] = (pd.NaT, pd.NaT)
 
         return df, self.quality_report
 
@@ -92,7 +128,7 @@ class DeviationDetectorAgent:
 
         df_dur = self._add_durations(df)
         case_dur_df = self._calculate_case_durations(df_dur)
-        valid_transitions = df_dur.dropna(subset=['duration_h']).copy()
+        valid_transitions = df_dur.dropna(subset=['duration_h'])
 
         deviations = []
 
@@ -123,32 +159,154 @@ class DeviationDetectorAgent:
         ts_col = 'time:timestamp'
         act_col = 'concept:name'
 
-        # Сортировка перед shift: максимально стабильный способ (через pandas datetime)
-        df = df.sort_values([case_col, ts_col]).reset_index(drop=True)
-
-        # Вычисляем длительность в часах через стандартный Pandas dt.total_seconds()
-        # Это обходит все проблемы с ручным вычитанием наносекунд и переполнением типов.
-        ts_converted = pd.to_datetime(df[ts_col])
-        next_ts = ts_converted.groupby(df[case_col]).shift(-1)
-        
-        df['duration_h'] = (next_ts - ts_converted).dt.total_seconds() / 3600.0
+        # Сортировка перед shift. После preprocess_event_log лог уже упорядочен по (кейс, время),
+        # поэтому O(N) проверка порядка позволяет пропустить повторную O(N log N) сортировку.
+        # Массив datetime64[ns] строим один раз и переиспользуем, если сортировка не понадобилась
+        ts_values = self._datetime_values(df[ts_col])
+        if not self._is_sorted_by_case_and_time(df[case_col], ts_values):
+            df = df.sort_values([case_col, ts_col])
+            ts_values = self._datetime_values(df[ts_col])
+        df = df.reset_index(drop=True)
+
+        # Вычисляем длительность в часах одним проходом по отсортированным массивам:
+        # разница соседних int64-наносекунд, маскированная на границах кейсов (без groupby).
+        ts_ns = ts_values.view('i8')
+        cases = df[case_col].to_numpy()
+
+        same_case = (cases[1:] == cases[:-1]) & ~np.isnat(ts_values[1:]) & ~np.isnat(ts_values[:-1])
+        duration_h = np.full(len(df), np.nan)
+        duration_h[:-1] = np.where(same_case, (ts_ns[1:] - ts_ns[:-1]) / 3.6e12, np.nan)
+
+        df['duration_h'] = duration_h
         df.loc[df['duration_h'] < 0, 'duration_h'] = np.nan
 
-        df['prev_act'] = df.groupby(case_col)[act_col].shift(1)
-        df['prev2_act'] = df.groupby(case_col)[act_col].shift(2)
-        df['next_act'] = df.groupby(case_col)[act_col].shift(-1)
+        # Коды кейсов и активностей считаем один раз (в отсортированном порядке имен, как у groupby)
+        # и сохраняем в логе: детекторы работают с ними, не факторизуя строки заново
+        act_codes, self._act_names = pd.factorize(df[act_col], sort=True)
+        case_codes, self._case_names = pd.factorize(cases, sort=True)
+        next_codes = self._shift_within_case(act_codes, case_codes, -1)
+        df['case_code'] = case_codes
+        df['act_code'] = act_codes
+        df['next_act_code'] = next_codes
+
+        # Соседние активности: сдвигаем плотные int-коды вместо хэширования строк в groupby
+        act_names = np.append(np.asarray(self._act_names, dtype=object), np.nan)
+
+        df['prev_act'] = act_names[self._shift_within_case(act_codes, case_codes, 1)]
+        df['prev2_act'] = act_names[self._shift_within_case(act_codes, case_codes, 2)]
+        df['next_act'] = act_names[next_codes]
         return df
 
+    @classmethod
+    def _is_sorted_by_case_and_time(cls, cases: pd.Series, timestamps) -> bool:
+        """Проверяет за O(N), что лог уже отсортирован по (кейс, время) и не содержит NaT.
+
+        timestamps — колонка лога или уже готовый массив datetime64[ns].
+        """
+        if len(cases) < 2:
+            return True
+        ts_values = timestamps if isinstance(timestamps, np.ndarray) else cls._datetime_values(timestamps)
+        if np.isnat(ts_values).any():
+            return False
+        ts_ns = ts_values.view('i8')
+        case_values = cases.to_numpy()
+        try:
+            same_case = case_values[1:] == case_values[:-1]
+            ordered = (case_values[1:] > case_values[:-1]) | (same_case & (ts_ns[1:] >= ts_ns[:-1]))
+        except TypeError:
+            return False  # несравнимые типы идентификаторов — пусть сортирует pandas
+        return bool(ordered.all())
+
+    @staticmethod
+    def _position_within_case(cases: np.ndarray) -> np.ndarray:
+        """Порядковый номер события внутри кейса (аналог groupby().cumcount())."""
+        n = len(cases)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+        starts = np.concatenate(([0], np.flatnonzero(cases[1:] != cases[:-1]) + 1))
+        # Лог отсортирован по кейсу — каждый кейс занимает один непрерывный блок
+        if len(starts) != len(pd.unique(cases[starts])):
+            return pd.Series(cases).groupby(cases).cumcount().to_numpy()
+        run_lengths = np.diff(np.append(starts, n))
+        return np.arange(n) - np.repeat(starts, run_lengths)
+
+    @staticmethod
+    def _count_unique(series: pd.Series) -> int:
+        """Число уникальных значений без NaN (как nunique), через pd.unique по numpy-массиву."""
+        uniques = pd.unique(series.to_numpy())
+        return int((~pd.isna(uniques)).sum())
+
+    @staticmethod
+    def _group_mean(codes: np.ndarray, values: np.ndarray, n_groups: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Средние и размеры групп по целочисленным кодам за пару проходов np.bincount."""
+        counts = np.bincount(codes, minlength=n_groups)
+        safe_counts = np.maximum(counts, 1)
+        means = np.bincount(codes, weights=values, minlength=n_groups) / safe_counts
+        # Второй проход по остаткам компенсирует ошибку округления наивной суммы
+        means += np.bincount(codes, weights=values - means[codes], minlength=n_groups) / safe_counts
+        return means, counts
+
+    @staticmethod
+    def _sorted_median(values: np.ndarray) -> float:
+        """Медиана уже отсортированного массива по индексу, без повторного partition."""
+        mid = len(values) // 2
+        if len(values) % 2:
+            return values[mid]
+        return (values[mid - 1] + values[mid]) / 2
+
+    @classmethod
+    def _datetime_values(cls, series: pd.Series) -> np.ndarray:
+        """Колонка времени как массив datetime64[ns] (UTC для tz-aware) — основа для int64-представления."""
+        return cls._as_datetime(series).to_numpy(dtype='datetime64[ns]')
+
+    @staticmethod
+    def _as_datetime(series: pd.Series) -> pd.Series:
+        """Возвращает колонку как datetime64, не перепарсивая её, если она уже в этом типе."""
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return series
+        return pd.to_datetime(series)
+
+    @staticmethod
+    def _shift_within_case(codes: np.ndarray, case_codes: np.ndarray, periods: int) -> np.ndarray:
+        """Аналог groupby(case).shift(periods) для отсортированных по кейсу кодов; -1 = нет значения."""
+        shifted = np.full(len(codes), -1, dtype=np.int64)
+        if abs(periods) >= len(codes):
+            return shifted
+        if periods > 0:
+            same = case_codes[periods:] == case_codes[:-periods]
+            shifted[periods:] = np.where(same, codes[:-periods], -1)
+        else:
+            same = case_codes[:periods] == case_codes[-periods:]
+            shifted[:periods] = np.where(same, codes[-periods:], -1)
+        return shifted
+
     def _calculate_case_durations(self, df_dur: pd.DataFrame) -> pd.DataFrame:
         case_col = 'case:concept:name'
         ts_col = 'time:timestamp'
         
+        ts = df_dur[ts_col]
+        if len(df_dur) and pd.api.types.is_datetime64_any_dtype(ts):
+            ts_values = self._datetime_values(ts)
+            if self._is_sorted_by_case_and_time(df_dur[case_col], ts_values):
+                # Лог упорядочен и без NaT: min/max кейса — его первое и последнее событие,
+                # берем их по границам блоков вместо groupby().agg(['min', 'max'])
+                cases = df_dur[case_col].to_numpy()
+                starts = np.concatenate(([0], np.flatnonzero(cases[1:] != cases[:-1]) + 1))
+                ends = np.append(starts[1:], len(cases)) - 1
+                ts_ns = ts_values.view('i8')
+                case_dur = pd.DataFrame(
+                    {'min': ts.array.take(starts), 'max': ts.array.take(ends)},
+                    index=pd.Index(cases[starts], name=case_col)
+                )
+                case_dur['duration_h'] = (ts_ns[ends] - ts_ns[starts]) / 1e9 / 3600.0
+                return case_dur
+
         # Находим разницу между макс и мин временем кейса
         case_dur = df_dur.groupby(case_col)[ts_col].agg(['min', 'max'])
         
         # Конвертация в Series для вычисления diff (так как в колонках сейчас могут быть pydatetime)
-        c_min = pd.to_datetime(case_dur['min'])
-        c_max = pd.to_datetime(case_dur['max'])
+        c_min = self._as_datetime(case_dur['min'])
+        c_max = self._as_datetime(case_dur['max'])
         
         case_dur['duration_h'] = (c_max - c_min).dt.total_seconds() / 3600.0
         return case_dur
@@ -184,16 +342,8 @@ class DeviationDetectorAgent:
                 'Повторение пары операций (A-B-A). Характерно для доработок'
             ))
 
-        # 3. Возвраты
-        def get_returns(group):
-            seen, found = set(), set()
-            for act in group:
-                if act in seen: found.add(act)
-                seen.add(act)
-            return list(found)
-            
-        returns_series = df.groupby('case:concept:name')[act_col].apply(get_returns)
-        all_returns = set(x for lst in returns_series for x in lst)
+        # 3. Возвраты: активность повторно встречается в том же кейсе
+        all_returns = df.loc[df.duplicated(['case:concept:name', act_col]), act_col].unique()
         
         for act in all_returns:
             results.append(self._create_row(
@@ -208,12 +358,15 @@ class DeviationDetectorAgent:
         if dur.empty: return []
         
         results = []
-        p95 = dur.quantile(0.95)
+        # Все квантили одним вызовом — одна выборка порядковых статистик вместо трёх
+        Q1, Q3, p95 = dur.quantile([0.25, 0.75, 0.95]).to_numpy()
         
-        long_cases = case_dur_df[case_dur_df['duration_h'] > p95]
-        for case_id, row in long_cases.iterrows():
+        # Берем только колонку длительностей и идем по (кейс, значение) без построчной упаковки iterrows
+        case_hours = case_dur_df['duration_h']
+        long_cases = case_hours[case_hours > p95]
+        for case_id, hours in zip(long_cases.index, long_cases.to_numpy()):
             results.append(self._create_row(
-                'Долгий цикл (Long Cycle Time)', 'Долгий цикл', case_id, f"Длительность: {row['duration_h']:.2f}ч",
+                'Долгий цикл (Long Cycle Time)', 'Долгий цикл', case_id, f"Длительность: {hours:.2f}ч",
                 'Превышение времени выполнения процесса над нормативом'
             ))
             results.append(self._create_row(
@@ -222,12 +375,11 @@ class DeviationDetectorAgent:
             ))
             
         # Outliers (IQR)
-        Q1, Q3 = dur.quantile(0.25), dur.quantile(0.75)
         IQR = Q3 - Q1
-        outliers = case_dur_df[(case_dur_df['duration_h'] < Q1 - 1.5 * IQR) | (case_dur_df['duration_h'] > Q3 + 1.5 * IQR)]
-        for case_id, row in outliers.head(10).iterrows():
+        outliers = case_hours[(case_hours < Q1 - 1.5 * IQR) | (case_hours > Q3 + 1.5 * IQR)].head(10)
+        for case_id, hours in zip(outliers.index, outliers.to_numpy()):
             results.append(self._create_row(
-                'Аномалии (Outliers)', 'Выброс длительности кейса', case_id, f"{row['duration_h']:.2f}ч",
+                'Аномалии (Outliers)', 'Выброс длительности кейса', case_id, f"{hours:.2f}ч",
                 'Статистически значимое отклонение длительности кейса от нормы (по IQR)'
             ))
             
@@ -235,10 +387,25 @@ class DeviationDetectorAgent:
 
     def _detect_bottlenecks(self, valid_tdf: pd.DataFrame) -> List[dict]:
         if valid_tdf.empty: return []
-        act_col = 'concept:name'
         
-        bottlenecks = valid_tdf.groupby([act_col, 'next_act'])['duration_h'].agg(['mean', 'count'])
-        bottlenecks = bottlenecks[bottlenecks['count'] > 5].sort_values('mean', ascending=False).head(5)
+        # Сумма и число переходов по парам (from, to) через bincount вместо groupby().agg()
+        from_codes, to_codes = valid_tdf['act_code'].to_numpy(), valid_tdf['next_act_code'].to_numpy()
+        from_names = to_names = self._act_names
+        dur = valid_tdf['duration_h'].to_numpy(dtype=float)
+        valid = (from_codes >= 0) & (to_codes >= 0) & ~np.isnan(dur)
+        pair_codes = from_codes[valid].astype(np.int64) * len(to_names) + to_codes[valid]
+        n_pairs = len(from_names) * len(to_names)
+        means, counts = self._group_mean(pair_codes, dur[valid], n_pairs)
+
+        # Пары в лексикографическом порядке, как после groupby
+        present = np.flatnonzero(counts)
+        bottlenecks = pd.DataFrame(
+            {'mean': means[present], 'count': counts[present]},
+            index=pd.MultiIndex.from_arrays([
+                from_names[present // len(to_names)], to_names[present % len(to_names)]
+            ])
+        )
+        bottlenecks = bottlenecks[bottlenecks['count'] > 5].nlargest(5, 'mean')
         
         results = []
         for (a1, a2), row in bottlenecks.iterrows():
@@ -276,22 +443,39 @@ class DeviationDetectorAgent:
             ))
             
         # Разовые инциденты (через IQR)
-        for act, group in valid_tdf.groupby(act_col):
-            dur = group['duration_h'].dropna()
-            if len(dur) < 10: continue
-            
-            Q1, Q3 = dur.quantile(0.25), dur.quantile(0.75)
-            clean = dur[(dur >= Q1 - 1.5 * (Q3 - Q1)) & (dur <= Q3 + 1.5 * (Q3 - Q1))]
-            outliers_count = len(dur) - len(clean)
-            
-            if outliers_count > 0:
-                clean_med = clean.median()
-                clean_diff = abs(clean.mean() - clean_med) / clean_med if clean_med > 0 else 0
-                if clean_diff < 0.1 and abs(dur.mean() - dur.median()) / dur.median() > 0.1:
-                    results.append(self._create_row(
-                        'Разовые инциденты', 'Аномальный сбой', act, f"Аномалий: {outliers_count} шт",
-                        'Единичные длительные операции на фоне нормального выполнения'
-                    ))
+        # Один lexsort по (активность, длительность): у каждой активности получается
+        # отсортированный срез, и квартили, медианы и «чистая» часть берутся индексами.
+        dur_all = valid_tdf['duration_h'].to_numpy(dtype=float)
+        act_codes, act_names = valid_tdf['act_code'].to_numpy(), self._act_names
+        keep = (act_codes >= 0) & ~np.isnan(dur_all)
+        act_codes, dur_all = act_codes[keep], dur_all[keep]
+        order = np.lexsort((dur_all, act_codes))
+        sorted_codes, sorted_dur = act_codes[order], dur_all[order]
+        bounds = np.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(sorted_codes)]))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for start, end in zip(starts, ends):
+                dur = sorted_dur[start:end]
+                if len(dur) < 10: continue
+
+                Q1, Q3 = np.quantile(dur, [0.25, 0.75])
+                lo = np.searchsorted(dur, Q1 - 1.5 * (Q3 - Q1), side='left')
+                hi = np.searchsorted(dur, Q3 + 1.5 * (Q3 - Q1), side='right')
+                clean = dur[lo:hi]
+                outliers_count = len(dur) - len(clean)
+
+                if outliers_count > 0:
+                    clean_med = self._sorted_median(clean)
+                    clean_diff = abs(clean.mean() - clean_med) / clean_med if clean_med > 0 else 0
+                    dur_med = self._sorted_median(dur)
+                    if clean_diff < 0.1 and abs(dur.mean() - dur_med) / dur_med > 0.1:
+                        results.append(self._create_row(
+                            'Разовые инциденты', 'Аномальный сбой', act_names[sorted_codes[start]],
+                            f"Аномалий: {outliers_count} шт",
+                            'Единичные длительные операции на фоне нормального выполнения'
+                        ))
                     
         # Ручные исключения (очень долгие, но стабильные операции)
         overall_mean = valid_tdf['duration_h'].mean()
@@ -305,37 +489,64 @@ class DeviationDetectorAgent:
         return results
 
     def _detect_critical_steps(self, df_dur: pd.DataFrame, case_dur_df: pd.DataFrame) -> List[dict]:
-        act_dur = df_dur.dropna(subset=['duration_h']).groupby(['case:concept:name', 'concept:name'])['duration_h'].mean().unstack(fill_value=0)
+        # Матрица «кейс × этап» средних длительностей: bincount по кодам пар вместо groupby().mean().unstack()
+        dur = df_dur['duration_h'].to_numpy(dtype=float)
+        case_codes, case_names = df_dur['case_code'].to_numpy(), self._case_names
+        act_codes, act_names = df_dur['act_code'].to_numpy(), self._act_names
+        valid = (case_codes >= 0) & (act_codes >= 0) & ~np.isnan(dur)
+        case_codes, act_codes = case_codes[valid], act_codes[valid]
+        n_acts = len(act_names)
+        means, counts = self._group_mean(case_codes.astype(np.int64) * n_acts + act_codes, dur[valid], len(case_names) * n_acts)
+
+        # Только кейсы и этапы, у которых есть хотя бы один переход
+        used_cases, used_acts = np.unique(case_codes), np.unique(act_codes)
+        matrix = np.where(counts > 0, means, 0.0).reshape(len(case_names), n_acts)[np.ix_(used_cases, used_acts)]
+        act_dur = pd.DataFrame(matrix, index=pd.Index(case_names[used_cases], name='case:concept:name'),
+                               columns=pd.Index(act_names[used_acts], name='concept:name'))
         if act_dur.empty: return []
 
         target = case_dur_df[['duration_h']].rename(columns={'duration_h': 'total_h'})
         act_dur = act_dur.join(target, how='inner')
 
+        act_cols = [c for c in act_dur.columns if c != 'total_h']
+        X = act_dur[act_cols].to_numpy(dtype=float)
+        y = act_dur['total_h'].to_numpy(dtype=float)
+        # Константные колонки не коррелируют ни с чем (как и при std() == 0)
+        varying = X.max(axis=0, initial=-np.inf) > X.min(axis=0, initial=np.inf)
+
+        # Пирсон всех этапов с итогом одним матричным умножением вместо цикла по Series.corr
+        rows = ~np.isnan(y)
+        Xc = X[rows] - X[rows].mean(axis=0)
+        yc = y[rows] - y[rows].mean()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corrs = (Xc.T @ yc) / (np.sqrt((Xc * Xc).sum(axis=0)) * np.sqrt(yc @ yc))
+
         results = []
-        for col in [c for c in act_dur.columns if c != 'total_h']:
-            if act_dur[col].std() > 0:
-                corr = act_dur[col].corr(act_dur['total_h'])
-                if corr > 0.5:
-                    results.append(self._create_row(
-                        'Критически важный этап', 'Высокая корреляция с итогом', col, f"Корреляция: {corr:.2f}",
-                        'Длительность этой операции наиболее сильно влияет на общую длительность всего процесса'
-                    ))
+        for col, corr, is_varying in zip(act_cols, corrs, varying):
+            if is_varying and corr > 0.5:
+                results.append(self._create_row(
+                    'Критически важный этап', 'Высокая корреляция с итогом', col, f"Корреляция: {corr:.2f}",
+                    'Длительность этой операции наиболее сильно влияет на общую длительность всего процесса'
+                ))
         return results
 
     def _detect_redundant_activities(self, df_dur: pd.DataFrame, case_dur_df: pd.DataFrame) -> List[dict]:
-        import scipy.stats as stats
-        total_cases = df_dur['case:concept:name'].nunique()
-        act_rate = df_dur.groupby('concept:name')['case:concept:name'].nunique() / total_cases
+        total_cases = self._count_unique(df_dur['case:concept:name'])
+        # Уникальные пары (активность, кейс) один раз — вместо фильтрации всего лога на каждую активность
+        pairs = df_dur[['concept:name', 'case:concept:name']].dropna().drop_duplicates()
+        cases_by_act = pairs.groupby('concept:name')['case:concept:name']
+        act_rate = cases_by_act.size() / total_cases
+        durations = case_dur_df['duration_h']
         
         results = []
         for act in act_rate[act_rate < 0.5].index:
-            cases_with_act = df_dur[df_dur['concept:name'] == act]['case:concept:name'].unique()
-            dur_with = case_dur_df.loc[case_dur_df.index.isin(cases_with_act), 'duration_h'].dropna()
-            dur_without = case_dur_df.loc[~case_dur_df.index.isin(cases_with_act), 'duration_h'].dropna()
+            has_act = case_dur_df.index.isin(cases_by_act.get_group(act))
+            dur_with = durations[has_act].dropna()
+            dur_without = durations[~has_act].dropna()
             
             if len(dur_with) > 5 and len(dur_without) > 5:
                 # Если наличие активности не замедляет и не ускоряет кейс
-                stat, p_val = stats.ttest_ind(dur_with.values, dur_without.values)
+                stat, p_val = scipy.stats.ttest_ind(dur_with.values, dur_without.values)
                 if p_val > 0.05:
                     results.append(self._create_row(
                         'Избыточные шаги (Redundant', 'Шаг не добавляющий ценности', act, None,
@@ -346,7 +557,7 @@ class DeviationDetectorAgent:
     def _detect_variability_and_dark_processes(self, df: pd.DataFrame) -> List[dict]:
         results = []
         try:
-            variants = pm4py.get_variants(df)
+            variants = self._get_variants(df)
             total = sum(variants.values())
             if total == 0: return results
             
@@ -374,16 +585,45 @@ class DeviationDetectorAgent:
                     'Скрытые сценарии (Dark Processes)', 'Неформализованные пути', 'Весь процесс', f"Редких путей: {dark_variants}",
                     'Сотни редких путей выполнения, отсутствующих в стандартных регламентах'
                 ))
-        except Exception as e:
-            pass # Если pm4py сломается, проигнорируем
+        except (KeyError, TypeError, ValueError):
+            # Лог без стандартных колонок или с несравнимыми типами case id (lexsort не
+            # может их упорядочить) — без вариантов метрики вариативности не считаем
+            pass
         return results
 
+    def _get_variants(self, df: pd.DataFrame) -> Counter:
+        """Частоты вариантов с кэшем: повторный анализ того же лога не пересчитывает трассы."""
+        key = (id(df), len(df), tuple(df.index[[0, -1]]) if len(df) else ())
+        if self._variants is None or self._variants_key != key:
+            self._variants = self._count_variants(df['case:concept:name'], df['concept:name'], df['time:timestamp'])
+            self._variants_key = key
+        return self._variants
+
+    @classmethod
+    def _count_variants(cls, cases: pd.Series, activities: pd.Series, timestamps: pd.Series) -> Counter:
+        """Частоты вариантов (последовательностей активностей по кейсам) без pm4py."""
+        # После preprocess_event_log лог уже упорядочен — сортируем только при необходимости
+        if not cls._is_sorted_by_case_and_time(cases, timestamps):
+            order = np.lexsort((cls._datetime_values(timestamps), cases.to_numpy()))
+            cases, activities = cases.iloc[order], activities.iloc[order]
+        case_values = cases.to_numpy()
+        if len(case_values) == 0:
+            return Counter()
+
+        # Трасса кодируется байтами int32-кодов активностей — компактный хешируемый ключ
+        act_codes = pd.factorize(activities)[0].astype(np.int32)
+        edges = np.concatenate((
+            [0], np.flatnonzero(case_values[1:] != case_values[:-1]) + 1, [len(case_values)]
+        ))
+        return Counter(act_codes[start:end].tobytes() for start, end in zip(edges[:-1], edges[1:]))
+
     def _detect_rework_loops(self, valid_tdf: pd.DataFrame) -> List[dict]:
         case_col = 'case:concept:name'
         act_col = 'concept:name'
         
-        df = valid_tdf.copy()
-        df['pos'] = df.groupby(case_col).cumcount()
+        # Берем только нужные колонки вместо копии всего (потенциально широкого) лога
+        df = valid_tdf[[case_col, act_col, 'next_act']].copy()
+        df['pos'] = self._position_within_case(df[case_col].to_numpy())
         avg_pos = df.groupby(act_col)['pos'].median().sort_values()
         order = {act: i for i, act in enumerate(avg_pos.index)}
 
@@ -393,7 +633,7 @@ class DeviationDetectorAgent:
 
         if rework.empty: return []
         
-        rework_summary = rework.groupby([act_col, 'next_act']).size().sort_values(ascending=False).head(5)
+        rework_summary = rework.groupby([act_col, 'next_act']).size().nlargest(5)
         
         results = []
         for (a1, a2), count in rework_summary.items():
@@ -422,9 +662,7 @@ class DeviationDetectorAgent:
             lines.append(f"> {desc}")
             
             items_list = []
-            for _, row in group.iterrows():
-                obj_id = row['object_id']
-                metric = row['metric']
+            for obj_id, metric in zip(group['object_id'], group['metric']):
                 if pd.notna(metric) and metric:
                     items_list.append(f"`{obj_id}` ({metric})")
                 else:
@@ -1,12 +1,35 @@
 import pandas as pd
 import numpy as np
-import json
+import logging
 import re
+import sys
+import warnings
+
+# Регулярки для ISO дат (2025-01-01, 2025-01-01T12:00:00, 01.01.2025, 2025/01/01),
+# собранные в один скомпилированный шаблон
+_DATE_PREFIX_RE = re.compile(
+    r'^(?:\d{4}-\d{2}-\d{2}'   # 2025-01-01, 2025-01-01T12:00
+    r'|\d{2}\.\d{2}\.\d{4}'   # 01.01.2025
+    r'|\d{4}/\d{2}/\d{2})'     # 2025/01/01
+)
+
+# Чистый ISO без часового пояса (2025-01-01, 2025-01-01 12:00, 2025-01-01T12:00:00.123):
+# такой формат numpy разбирает прямым приведением типа
+_ISO_DATETIME_RE = re.compile(r'^\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2}(?:\.\d{1,9})?)?)?$')
+# Диапазон datetime64[ns] (1677-09-21 … 2262-04-11) с запасом в сутки, в секундах:
+# numpy за его пределами не падает, а молча переполняет наносекунды
+_NS_SAFE_MIN = np.datetime64('1677-09-22', 's')
+_NS_SAFE_MAX = np.datetime64('2262-04-10', 's')
+
+logger = logging.getLogger(__name__)
 
 class DataFormatterAgent:
     def __init__(self, df: pd.DataFrame, llm_client):
         self.df = df
         self.llm = llm_client
+        # Кэш результата определения типов (привязан к конкретному DataFrame)
+        self._type_map = None
+        self._type_map_df_id = None
 
     def _is_datetime_like(self, series: pd.Series) -> bool:
         """Heuristic to detect if a column looks like it contains dates."""
@@ -20,26 +43,13 @@ class DataFormatterAgent:
             if sample.empty:
                 return False
             
-            # Регулярки для ISO дат (2025-01-01, 2025-01-01T12:00:00, etc)
-            date_patterns = [
-                r'^\d{4}-\d{2}-\d{2}',           # 2025-01-01
-                r'^\d{2}\.\d{2}\.\d{4}',         # 01.01.2025
-                r'^\d{4}/\d{2}/\d{2}',           # 2025/01/01
-                r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}' # 2025-01-01T12:00
-            ]
-            
-            matches = 0
-            for val in sample:
-                val = val.strip()
-                if any(re.search(p, val) for p in date_patterns):
-                    matches += 1
+            # Один проход по выборке единым шаблоном вместо перебора регулярок на каждое значение
+            matches = int(sample.str.strip().str.match(_DATE_PREFIX_RE).sum())
             
             return (matches / len(sample)) > 0.3
             
         return False
 
-        return False
-
     def _robust_to_datetime(self, series: pd.Series) -> pd.Series:
         """
         Exclusive point for datetime conversion. 
@@ -47,6 +57,21 @@ class DataFormatterAgent:
         """
         # Превращаем в список строк — это гарантированно обходит любые прокси cudf
         s_list = series.astype(str).tolist()
+
+        # Быстрый путь: приведение к datetime64 в numpy без парсера pandas.
+        # Любое значение не в ISO (или со смещением пояса — numpy молча перевёл бы его в UTC)
+        # даёт исключение, и тогда работает обычный перебор форматов ниже.
+        # Сначала разбираем с точностью до секунд (без переполнения) и проверяем диапазон:
+        # годы вне 1677–2262 уходят в перебор, который вернёт для них NaT
+        if s_list and _ISO_DATETIME_RE.match(s_list[0]):
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('error', DeprecationWarning)
+                    seconds = np.array(s_list, dtype='datetime64[s]')
+                    if not ((seconds < _NS_SAFE_MIN) | (seconds > _NS_SAFE_MAX)).any():
+                        return pd.Series(np.array(s_list, dtype='datetime64[ns]'))
+            except (ValueError, DeprecationWarning):
+                pass
         
         formats = [
             'ISO8601', 
@@ -83,15 +108,14 @@ class DataFormatterAgent:
         # Это в точности соответствует тому, что делал старый DataProcessor
         return pd.Series(best_ts).astype('datetime64[ns]')
 
-    def run(self) -> pd.DataFrame:
+    def _detect_column_types(self) -> dict:
         """
-        Analyzes column types and converts them (int, float, datetime).
-        Aggressively forces dates to a consistent format.
+        Asks the LLM for the target type of each column.
+        The result is cached per DataFrame, so repeated runs skip the LLM call.
         """
-        print("Starting Data Formatting...")
-        df_new = self.df.copy()
-        
-        # 1. Сначала пытаемся угадать типы через LLM (для бизнес-логики)
+        if self._type_map is not None and self._type_map_df_id == id(self.df):
+            return self._type_map
+
         type_map = {}
         try:
             sample_str = self.df.head(5).to_string()
@@ -107,20 +131,46 @@ class DataFormatterAgent:
             response = self.llm.generate_response(prompt, system_prompt)
             type_map = self.llm._parse_json(response) or {}
         except Exception as e:
-            print(f"LLM Type Detection warning: {e}")
+            logger.warning("LLM Type Detection warning: %s", e)
+            return type_map
+
+        self._type_map = type_map
+        self._type_map_df_id = id(self.df)
+        return type_map
+
+    def run(self) -> pd.DataFrame:
+        """
+        Analyzes column types and converts them (int, float, datetime).
+        Aggressively forces dates to a consistent format.
+        """
+        logger.info("Starting Data Formatting...")
+        # Поверхностная копия: колонки ниже только переприсваиваются целиком,
+        # поэтому исходные данные не меняются и не дублируются в памяти
+        df_new = self.df.copy(deep=False)
+        
+        # 1. Сначала пытаемся угадать типы через LLM (для бизнес-логики)
+        type_map = self._detect_column_types()
 
         # 2. Применяем конвертации
         for col in df_new.columns:
             target_type = type_map.get(col)
+
+            # Уже datetime64 — повторный парсинг через строки ничего не меняет.
+            # Под cudf.pandas оставляем прежний путь через список (обход прокси)
+            if pd.api.types.is_datetime64_any_dtype(df_new[col]) and 'cudf.pandas' not in sys.modules:
+                if not isinstance(df_new[col].dtype, pd.DatetimeTZDtype):
+                    df_new[col] = df_new[col].astype('datetime64[ns]')
+                continue
             
             if target_type == 'datetime' or self._is_datetime_like(df_new[col]):
                 try:
                     # ПРАВИЛЬНЫЙ ПАРСИНГ: (Многоформатный перебор)
                     df_new[col] = self._robust_to_datetime(df_new[col])
-                    print(f"Column '{col}' FORCED to datetime64[ns] (Robust Parser)")
+                    # Сообщения по каждой колонке — только на уровне DEBUG
+                    logger.debug("Column '%s' FORCED to datetime64[ns] (Robust Parser)", col)
                     continue
                 except Exception as e:
-                    print(f"Error forced-converting '{col}' to datetime: {e}")
+                    logger.warning("Error forced-converting '%s' to datetime: %s", col, e)
 
             # Числовые типы
             if target_type in ['int', 'float']:
@@ -128,8 +178,8 @@ class DataFormatterAgent:
                     df_new[col] = pd.to_numeric(df_new[col], errors='coerce')
                     if target_type == 'int' and df_new[col].notna().all():
                         df_new[col] = df_new[col].astype('int64')
-                    print(f"Column '{col}' converted to {target_type}")
+                    logger.debug("Column '%s' converted to %s", col, target_type)
                 except Exception as e:
-                    print(f"Error converting '{col}' to {target_type}: {e}")
+                    logger.warning("Error converting '%s' to %s: %s", col, target_type, e)
 
         return df_new
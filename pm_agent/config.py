@@ -3,20 +3,38 @@ from pathlib import Path
 
 import yaml
 
+try:
+    # libyaml C extension: noticeably faster than the pure-Python loader
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
 # Define base paths
 BASE_DIR = Path(__file__).resolve().parent.parent
 CONFIG_PATH = BASE_DIR / "config.yaml"
 
+# Parsed config and the mtime it was read at; re-parsed only when the file changes
+_config_cache = None
+_config_mtime = None
+
 
 def load_config():
+    global _config_cache, _config_mtime
+
     if not CONFIG_PATH.exists():
         raise FileNotFoundError(
             f"Configuration file not found at {CONFIG_PATH}\n"
             f"Please copy config.example.yaml to config.yaml and fill in your settings."
         )
 
+    mtime = CONFIG_PATH.stat().st_mtime_ns
+    if _config_cache is not None and mtime == _config_mtime:
+        return _config_cache
+
     with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+        _config_cache = yaml.load(f, Loader=_YamlLoader)
+    _config_mtime = mtime
+    return _config_cache
 
 
 config = load_config()
@@ -28,12 +46,17 @@ PROVIDER = config.get("provider", "mistral")
 mistral_config = config.get("mistral", {})
 MISTRAL_API_KEY = mistral_config.get("api_key")
 MISTRAL_MODEL = mistral_config.get("model", "mistral-small-latest")
+# Optional cheaper model for verification/interpretation calls; defaults to MISTRAL_MODEL
+MISTRAL_FAST_MODEL = mistral_config.get("fast_model") or MISTRAL_MODEL
 
 # Extract Local Model Config (OpenAI-compatible API)
 local_config = config.get("local", {})
 LOCAL_BASE_URL = local_config.get("base_url", "http://localhost:11434/v1")
 LOCAL_MODEL = local_config.get("model", "llama3.2")
 LOCAL_API_KEY = local_config.get("api_key", "ollama")
+# Opt-in server-side JSON mode (response_format=json_object); not every
+# OpenAI-compatible server accepts it, e.g. LM Studio answers 400
+LOCAL_JSON_MODE = bool(local_config.get("json_mode", False))
 
 # Extract GigaChat Config
 gigachat_config = config.get("gigachat", {})
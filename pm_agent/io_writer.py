@@ -0,0 +1,82 @@
+"""
+Background file writer.
+Persists session files from a single daemon thread, so the chat loop
+does not wait on disk before the next LLM call.
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundWriter:
+    """
+    Performs queued writes in order: submit() replaces a file atomically,
+    append() adds bytes to the end of one.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        # O_APPEND descriptors kept open across appends; used only by the writer thread
+        self._append_fds = {}
+        self._thread = threading.Thread(target=self._run, name="autopm-io-writer", daemon=True)
+        self._thread.start()
+        # Pending writes are completed before the interpreter exits
+        atexit.register(self.close)
+
+    def submit(self, path, data: bytes):
+        self._queue.put((Path(path), data, False))
+
+    def append(self, path, data: bytes):
+        self._queue.put((Path(path), data, True))
+
+    def flush(self):
+        """Blocks until every queued write has been completed."""
+        self._queue.join()
+
+    def close(self):
+        """Flushes pending writes and closes the append descriptors."""
+        self.flush()
+        for fd in self._append_fds.values():
+            os.close(fd)
+        self._append_fds.clear()
+
+    def _append(self, path: Path, data: bytes):
+        fd = self._append_fds.get(path)
+        if fd is None:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._append_fds[path] = fd
+        # Unbuffered: one write() syscall per chunk; the kernel positions it at the end
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+
+    def _run(self):
+        while True:
+            path, data, append = self._queue.get()
+            try:
+                if append:
+                    self._append(path, data)
+                else:
+                    # The file is replaced, so an open append descriptor would point at the old one
+                    fd = self._append_fds.pop(path, None)
+                    if fd is not None:
+                        os.close(fd)
+                    # Write next to the target and rename, so a crash never leaves a torn file
+                    tmp_path = path.with_name(path.name + ".tmp")
+                    tmp_path.write_bytes(data)
+                    os.replace(tmp_path, path)
+            except Exception as e:
+                # Any error (not just OSError) is logged: if it escaped, the thread would
+                # die and flush() at exit would wait forever on the remaining writes
+                logger.warning("⚠️ Не удалось сохранить %s: %s", path, e)
+            finally:
+                self._queue.task_done()
+
+
+writer = BackgroundWriter()
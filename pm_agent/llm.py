@@ -1,12 +1,29 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
 import time
+from collections import OrderedDict
+
+import httpx
+import numpy as np
+import orjson
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_mistralai import ChatMistralAI
-from openai import OpenAI
+from openai import DEFAULT_TIMEOUT, AsyncOpenAI, OpenAI
+from tenacity import AsyncRetrying, Retrying, retry_if_exception, stop_after_attempt
 from .config import (
     LOCAL_API_KEY,
     LOCAL_BASE_URL,
+    LOCAL_JSON_MODE,
     LOCAL_MODEL,
     MISTRAL_API_KEY,
+    MISTRAL_FAST_MODEL,
     MISTRAL_MODEL,
     PROVIDER,
     GIGACHAT_BASE_URL,
@@ -14,34 +31,346 @@ from .config import (
     GIGACHAT_MODEL,
 )
 
+logger = logging.getLogger(__name__)
+
+# System prompts are fixed per call type: built once at import and byte-identical
+# across calls, so provider-side prompt-prefix caching can reuse them.
+_SYS_ROUTER = (
+    "Ты — Эксперт-консультант по Process Mining с доступом к данным и базе знаний о платформе.\n"
+    "ПРАВИЛА:\n"
+    "1. Если вопрос касается ФУНКЦИОНАЛА ПЛАТФОРМЫ (как строить графики, как запустить ML, "
+    "как удалять данные, интерфейс, настройки) — верни needs_rag: true.\n"
+    "2. Если вопрос требует РАСЧЕТОВ по текущему датасету (среднее, медиана, фильтрация, топ-N) "
+    "— верни needs_code: true.\n"
+    "3. Отвечай на простые вопросы о структуре данных напрямую, если расчет не требуется.\n"
+    "4. Формат ответа СТРОГО JSON.\n"
+    "\n"
+    "ФОРМАТ ОТВЕТА:\n"
+    '{"answer": "Текст (если не нужен RAG/код)", "needs_code": false, "needs_rag": false}\n'
+    "Если нужен расчет:\n"
+    '{"answer": null, "needs_code": true, "needs_rag": false}\n'
+    "Если вопрос про инструкцию/платформу:\n"
+    '{"answer": null, "needs_code": false, "needs_rag": true}\n'
+)
+
+_SYS_PANDAS_CODE = (
+    "Ты — Эксперт по анализу данных. Твоя задача — написать pandas-код для ответа на вопрос пользователя.\n"
+    "\n"
+    "ДОСТУПНЫЕ ПЕРЕМЕННЫЕ:\n"
+    "- df: pandas DataFrame с данными (Process Mining Event Log)\n"
+    "- pd: pandas библиотека\n"
+    "- np: numpy библиотека\n"
+    "- plt: matplotlib.pyplot для визуализации\n"
+    "\n"
+    "ТЕРМИНОЛОГИЯ PROCESS MINING:\n"
+    "- АКТИВНОСТЬ (Activity) = Событие, строка в логе.\n"
+    "- ПУТЬ/ТРЕЙС (Trace, Variant) = ПОСЛЕДОВАТЕЛЬНОСТЬ активностей для одного case_id.\n"
+    "  Для анализа путей собери их в СТРОКУ: .apply(lambda x: ' -> '.join(x)).\n"
+    "\n"
+    "ПРАВИЛА:\n"
+    "1. ОБЯЗАТЕЛЬНО сохрани финальный результат в переменную 'result'.\n"
+    "2. Код должен быть простым и читаемым.\n"
+    "3. Используй только pandas/numpy/matplotlib операции.\n"
+    "4. ВИЗУАЛИЗАЦИЯ: Если нужен график, сохрани его через `plt.savefig('reports/temp_plot.png')` и установи `result = 'reports/temp_plot.png'`.\n"
+    "5. 'result' должен быть стандартным Python типом (int, float, dict, list, str). Используй .item() для numpy скаляров.\n"
+    "6. Результат должен быть JSON-сериализуемым.\n"
+    "\n"
+    "ПРИМЕРЫ (Few-Shot):\n"
+    "Вопрос: Сколько всего уникальных кейсов?\n"
+    "Код: result = df['case_id'].nunique()\n\n"
+    "Вопрос: Найди топ-5 самых частых активностей.\n"
+    "Код: result = df['activity'].value_counts().head(5).to_dict()\n\n"
+    "Вопрос: Построй график распределения длительности кейсов.\n"
+    "Код:\n"
+    "durations = df.groupby('case_id')['timestamp'].agg(lambda x: (x.max() - x.min()).total_seconds() / 3600)\n"
+    "plt.figure(figsize=(10,6))\n"
+    "counts, edges = np.histogram(durations.dropna().to_numpy(), bins=20)\n"
+    "plt.bar(edges[:-1], counts, width=np.diff(edges), align='edge')\n"
+    "plt.title('Распределение длительности кейсов (часы)')\n"
+    "plt.savefig('reports/temp_plot.png')\n"
+    "result = 'reports/temp_plot.png'\n"
+    "\n"
+    "7. БЕЗОПАСНАЯ СОРТИРОВКА (LINUX FIX): Если нужно сортировать по колонке с датой, ВСЕГДА используй промежуточный pd.to_numeric(pd.to_datetime(..., errors='coerce')).\n"
+    "   Пример: df.assign(ts_int=pd.to_numeric(pd.to_datetime(df['timestamp'], errors='coerce'))).sort_values(['case_id', 'ts_int']).drop(columns='ts_int')\n"
+    "8. НЕ ПЕРЕКОНВЕРТИРУЙ: Даты уже в формате datetime64[ns]. Не вызывай pd.to_datetime() повторно.\n"
+    "9. ЯДЕРНЫЙ ПЕРЕВОД В ЧИСЛА (LINUX FIX): Если нужны инты из дат, ВСЕГДА делай pd.to_numeric(pd.to_datetime(df['ts'], errors='coerce')).fillna(0).astype('int64'). Это защищает от object-массивов с NaT.\n"
+    "\n"
+    "ФОРМАТ ОТВЕТА (JSON):\n"
+    "{\n"
+    '  "thought": "Рассуждение: что нужно сделать и как",\n'
+    '  "code": "result = df..."\n'
+    "}"
+)
+
+_SYS_VERIFY = (
+    "Ты — строгий ИИ-Судья. Твоя задача — проверить, является ли результат выполнения кода КАЧЕСТВЕННЫМ ответом на вопрос.\n"
+    "\n"
+    "КРИТЕРИИ ПРОВЕРКИ:\n"
+    "1. ПОЛНОТА: Содержит ли результат все запрашиваемые данные?\n"
+    "2. РЕЛЕВАНТНОСТЬ: Соответствует ли ответ смыслу вопроса и контексту диалога?\n"
+    "3. ПРАВДОПОДОБНОСТЬ: Не выглядит ли результат заведомо ошибочным (например, пустой список там, где точно должны быть данные)?\n"
+    "\n"
+    "СПЕЦИАЛЬНЫЕ ПРАВИЛА:\n"
+    "- Если результат — путь к файлу (например, 'reports/temp_plot.png'), считай это валидным графиком.\n"
+    "- Если пользователь спросил 'Топ 10', а в результате 0 или 1 элемент без объяснения причин — это is_valid: false.\n"
+    "\n"
+    "ФОРМАТ ОТВЕТА (JSON):\n"
+    "{\n"
+    '  "is_valid": true | false,\n'
+    '  "critique": "Краткое описание проблемы, если есть",\n'
+    '  "suggestion": "Как исправить код, чтобы получить верный результат"\n'
+    "}\n"
+)
+
+_SYS_INTERPRET_CODE = (
+    "Ты — Эксперт-консультант по Process Mining.\n"
+    "Преврати результат выполнения кода в понятный ответ на русском языке.\n"
+    "НИКОГДА НЕ ВЫДУМЫВАЙ ЦИФРЫ. Используй ТОЛЬКО факты из результата.\n"
+    "Формат ответа: JSON {\"answer\": \"...\"}"
+)
+
+_SYS_RAG_ANSWER = (
+    "Ты технический писатель Платформы Process Mining. "
+    "Отвечай структурированно и по существу."
+)
+
+
+# Markdown fences and raw JSON fields in model output. Each fence pattern matches the
+# body up to the closing fence (or the end of an unterminated block).
+_JSON_FENCE_RE = re.compile(r"```json(.*?)(?:```|\Z)", re.DOTALL)
+_ANY_FENCE_RE = re.compile(r"```(.*?)(?:```|\Z)", re.DOTALL)
+_PYTHON_FENCE_RE = re.compile(r"```python(.*?)(?:```|\Z)", re.DOTALL)
+_CODE_FIELD_RE = re.compile(r'"code"\s*:\s*"((?:[^"\\]|\\.)*)"', re.DOTALL)
+_THOUGHT_FIELD_RE = re.compile(r'"thought"\s*:\s*"((?:[^"\\]|\\.)*)"', re.DOTALL)
+
+# Character budgets for unbounded prompt sections (roughly 4 chars per token)
+_MAX_CONTEXT_CHARS = 8000
+_MAX_HISTORY_MSG_CHARS = 1500
+_MAX_RESULT_CHARS = 4000
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    """Bounds a prompt section to its first `max_chars` characters."""
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + "\n... (обрезано)"
+
+
+def _format_history(history: list, limit: int) -> list:
+    """Renders the last `limit` chat messages as prompt lines."""
+    return [
+        f"{'Пользователь' if msg['role'] == 'user' else 'Ассистент'}: "
+        f"{_truncate(msg['text'], _MAX_HISTORY_MSG_CHARS)}"
+        for msg in history[-limit:]
+    ]
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """
+    Seconds to wait before retrying a rate-limited call: the server's Retry-After
+    hint when present, otherwise exponential backoff with jitter, so that parallel
+    requests do not all retry in the same instant.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    retry_after = headers.get("retry-after")
+    if retry_after is not None:
+        try:
+            return min(max(float(retry_after), 0.0), 60.0)
+        except ValueError:
+            pass  # HTTP-date form; fall through to backoff
+    return min(2 ** attempt + random.uniform(0, 1), 30.0)
+
+
+_MAX_RETRIES = 5
+
+
+def _is_rate_limited(error: BaseException) -> bool:
+    error_str = str(error)
+    return "429" in error_str or "Too Many Requests" in error_str
+
+
+def _is_retryable(error: BaseException) -> bool:
+    """Rate limits (429) and transient server errors (5xx) are worth retrying."""
+    if _is_rate_limited(error):
+        return True
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None) or getattr(error, "status_code", None)
+    return isinstance(status, int) and status >= 500
+
+
+def _wait_before_retry(retry_state) -> float:
+    return _retry_delay(retry_state.outcome.exception(), retry_state.attempt_number - 1)
+
+
+def _report_retry(retry_state):
+    if _is_rate_limited(retry_state.outcome.exception()):
+        reason = "Превышен лимит запросов (429)"
+    else:
+        reason = "Сервер LLM временно недоступен"
+    logger.warning(
+        "%s. Ожидание %.1f сек... (Попытка %d/%d)",
+        reason, retry_state.next_action.sleep, retry_state.attempt_number, _MAX_RETRIES,
+    )
+
+
+def _retry_policy(retry=retry_if_exception(_is_retryable)) -> dict:
+    """Shared tenacity settings for LLM calls: jittered backoff honouring Retry-After."""
+    return dict(
+        retry=retry,
+        stop=stop_after_attempt(_MAX_RETRIES),
+        wait=_wait_before_retry,
+        before_sleep=_report_retry,
+        reraise=True,
+    )
+
+
+def _extract_json(text: str):
+    """
+    Returns the largest balanced top-level {...} block in *text*, or None.
+    Single pass that tracks string/escape state, so braces inside JSON strings
+    or stray braces in surrounding prose do not break the match.
+    """
+    best = None
+    depth = 0
+    start = -1
+    in_string = False
+    escape = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            if depth:
+                in_string = True
+        elif ch == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == "}" and depth:
+            depth -= 1
+            if depth == 0 and (best is None or i + 1 - start > len(best)):
+                best = text[start:i + 1]
+    return best
+
+
 class LocalLLMClient:
     """Wrapper for native OpenAI client to match langchain interface."""
     def __init__(self, base_url: str, model: str, api_key: str, temperature: float = 0.2):
-        self.client = OpenAI(base_url=base_url, api_key=api_key)
+        # One keep-alive pool per client for the lifetime of the process (sync and async),
+        # so consecutive calls reuse open connections instead of reconnecting.
+        # The SDK takes its timeout from these clients, so keep its default (600 s):
+        # the bundled server may spend minutes generating a long answer on CPU
+        limits = httpx.Limits(max_keepalive_connections=10)
+        self.http_client = httpx.Client(limits=limits, timeout=DEFAULT_TIMEOUT)
+        self.async_http_client = httpx.AsyncClient(limits=limits, timeout=DEFAULT_TIMEOUT)
+        self.client = OpenAI(base_url=base_url, api_key=api_key, http_client=self.http_client)
+        self.async_client = AsyncOpenAI(
+            base_url=base_url, api_key=api_key, http_client=self.async_http_client
+        )
         self.model = model
         self.temperature = temperature
 
-    def invoke(self, messages: list, **kwargs) -> "LocalLLMResponse":
-        formatted_messages = []
-        for msg in messages:
-            if hasattr(msg, "content"):
-                role = "system" if isinstance(msg, SystemMessage) else "user"
-                formatted_messages.append({"role": role, "content": msg.content})
-            else:
-                formatted_messages.append(msg)
+    @staticmethod
+    def _format_messages(messages: list) -> list:
+        return [
+            {"role": "system" if isinstance(msg, SystemMessage) else "user", "content": msg.content}
+            if hasattr(msg, "content") else msg
+            for msg in messages
+        ]
 
+    def invoke(self, messages: list, **kwargs) -> "LocalLLMResponse":
         response = self.client.chat.completions.create(
-            model=self.model, messages=formatted_messages, temperature=self.temperature, **kwargs
+            model=self.model, messages=self._format_messages(messages),
+            temperature=self.temperature, **kwargs
+        )
+        return LocalLLMResponse(response.choices[0].message.content)
+
+    async def ainvoke(self, messages: list, **kwargs) -> "LocalLLMResponse":
+        response = await self.async_client.chat.completions.create(
+            model=self.model, messages=self._format_messages(messages),
+            temperature=self.temperature, **kwargs
         )
         return LocalLLMResponse(response.choices[0].message.content)
 
+    def stream(self, messages: list, **kwargs):
+        response = self.client.chat.completions.create(
+            model=self.model, messages=self._format_messages(messages),
+            temperature=self.temperature, stream=True, **kwargs
+        )
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield LocalLLMResponse(chunk.choices[0].delta.content)
+
 class LocalLLMResponse:
     def __init__(self, content: str):
         self.content = content
 
+class _DiskCache:
+    """
+    SQLite-backed response store, so identical requests are replayed across runs.
+    Entries older than `ttl_seconds` are ignored and overwritten on the next miss.
+    """
+    def __init__(self, path: str, ttl_seconds: int = 24 * 3600):
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT, created_at INTEGER)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM cache WHERE key = ? AND created_at > ?",
+                (key, int(time.time()) - self.ttl_seconds),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, response: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, response, created_at) VALUES (?, ?, ?)",
+                (key, response, int(time.time())),
+            )
+            self._conn.commit()
+
+
 class LLMClient:
-    def __init__(self, rag_manager=None):
+    def __init__(self, rag_manager=None, use_cache: bool = True, cache_overwrite: bool = False):
         self.rag_manager = rag_manager
+        # In-process LRU of exact-match responses; disable with use_cache=False or AUTOPM_LLM_CACHE=0
+        self._cache = OrderedDict()
+        self._cache_max = 512
+        self._cache_enabled = use_cache and os.environ.get("AUTOPM_LLM_CACHE", "1") != "0"
+        # Overwrite mode skips cache lookups but still stores fresh responses
+        self._cache_overwrite = cache_overwrite
+        # Optional persistent layer behind the LRU, e.g. AUTOPM_LLM_CACHE_DB=~/.autopm/llm_cache.sqlite
+        self._disk_cache = None
+        disk_cache_path = os.environ.get("AUTOPM_LLM_CACHE_DB")
+        if self._cache_enabled and disk_cache_path:
+            try:
+                self._disk_cache = _DiskCache(disk_cache_path)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("⚠️ Дисковый кэш LLM недоступен: %s", e)
+        # Semantic cache of knowledge-base answers: paraphrased platform questions
+        # reuse an earlier answer instead of paying two LLM round-trips again
+        self._semantic_vectors = None  # (N, d) float32, L2-normalised
+        self._semantic_entries = []  # [(context_hash, source_paths, response_dict)], aligned with vectors
+        # Calibrated for multilingual-e5 (the RAG model): its cosine scores sit around
+        # 0.7-1.0, so different questions on one topic easily pass 0.9; only close
+        # paraphrases that also retrieved the same documents are treated as a hit
+        self._semantic_threshold = 0.97
+        self._batch_loop = None  # event loop reused by generate_batch
         if PROVIDER == "local":
             self.client = LocalLLMClient(
                 base_url=LOCAL_BASE_URL,
@@ -60,100 +389,269 @@ class LLMClient:
             self.client = ChatMistralAI(
                 model_name=MISTRAL_MODEL, api_key=MISTRAL_API_KEY, temperature=0.2
             )
+        # Client for model_tier="fast" calls: a separate smaller Mistral model when
+        # configured, otherwise the main client. It reuses the main client's connection
+        # pools (same endpoint and key), so switching tiers needs no new TLS handshake.
+        self.fast_client = self.client
+        if PROVIDER not in ("local", "gigachat") and MISTRAL_FAST_MODEL != MISTRAL_MODEL:
+            self.fast_client = ChatMistralAI(
+                model_name=MISTRAL_FAST_MODEL, api_key=MISTRAL_API_KEY, temperature=0.2,
+                client=self.client.client, async_client=self.client.async_client,
+            )
+        # Model identity per tier for cache keys, so persisted answers are never replayed
+        # for a different provider, model or sampling temperature
+        model, temperature = {
+            "local": (LOCAL_MODEL, 0.2),
+            "gigachat": (GIGACHAT_MODEL, None),
+        }.get(PROVIDER, (MISTRAL_MODEL, 0.2))
+        fast_model = MISTRAL_FAST_MODEL if self.fast_client is not self.client else model
+        self._model_ids = {
+            "strong": f"{PROVIDER}:{model}:{temperature}",
+            "fast": f"{PROVIDER}:{fast_model}:{temperature}",
+        }
+        # Server-side JSON mode for json_mode=True calls. GigaChat has no equivalent and
+        # local servers get it only with local.json_mode: true; without it the prompt and
+        # _parse_json's fenced/embedded-JSON fallbacks do the job
+        json_mode_supported = PROVIDER not in ("gigachat", "local") or (PROVIDER == "local" and LOCAL_JSON_MODE)
+        self._json_kwargs = {"response_format": {"type": "json_object"}} if json_mode_supported else {}
 
     def _parse_json(self, response_str: str) -> dict:
         """Helper for internal needs (formatter.py still uses JSON)."""
-        import json
-        import re
         if not response_str: return None
+        # Already-parsed payloads (e.g. cached dicts) are passed through without a round-trip
+        if isinstance(response_str, (dict, list)): return response_str
         # Clean potential markdown blocks
-        clean_str = response_str
-        if "```json" in response_str:
-            clean_str = response_str.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_str:
-             clean_str = response_str.split("```")[1].split("```")[0].strip()
-        
-        try: return json.loads(clean_str)
-        except: pass
+        fence = _JSON_FENCE_RE.search(response_str) or _ANY_FENCE_RE.search(response_str)
+        clean_str = fence.group(1).strip() if fence else response_str
         
-        # Try regex if standard parsing fails
-        match = re.search(r"(\{.*\})", clean_str, re.DOTALL)
-        if match:
-            try: return json.loads(match.group(1))
-            except: pass
+        # Only attempt a direct parse when the text can be a JSON object/array, so plain
+        # prose goes straight to the scanner without raising a decode error first
+        if clean_str.lstrip()[:1] in ("{", "["):
+            with contextlib.suppress(orjson.JSONDecodeError):
+                return orjson.loads(clean_str)
+
+        # Fall back to the largest balanced JSON object embedded in the text
+        block = _extract_json(clean_str)
+        if block:
+            with contextlib.suppress(orjson.JSONDecodeError):
+                return orjson.loads(block)
         return None
 
+    def _cache_key(self, prompt: str, system_prompt: str, json_mode: bool, model_tier: str = "strong"):
+        if not self._cache_enabled:
+            return None
+        model_id = self._model_ids.get(model_tier, model_tier)
+        return hashlib.sha256(
+            f"{model_id}\x00{system_prompt}\x00{prompt}\x00{json_mode}".encode("utf-8")
+        ).hexdigest()
+
+    def _cache_get(self, key):
+        if key is None or self._cache_overwrite:
+            return None
+        if key not in self._cache:
+            content = self._disk_get(key)
+            if content is not None:
+                self._remember(key, content)
+            return content
+        self._cache.move_to_end(key)
+        return self._cache[key]
+
+    def _cache_put(self, key, content: str):
+        # An empty reply is a failed call, not an answer worth replaying
+        if key is None or not content:
+            return
+        self._remember(key, content)
+        if self._disk_cache is not None:
+            try:
+                self._disk_cache.put(key, content)
+            except sqlite3.Error as e:
+                logger.warning("⚠️ Не удалось записать в дисковый кэш LLM: %s", e)
+
+    def _remember(self, key, content: str):
+        self._cache[key] = content
+        if len(self._cache) > self._cache_max:
+            self._cache.popitem(last=False)
+
+    def _disk_get(self, key):
+        if self._disk_cache is None:
+            return None
+        try:
+            return self._disk_cache.get(key)
+        except sqlite3.Error:
+            return None
+
     def generate_response(
         self,
         prompt: str,
         system_prompt: str = "Ты полезный ИИ-ассистент.",
         json_mode: bool = False,
+        model_tier: str = "strong",
     ) -> str:
         """
-        Generates a response from the LLM with retry logic for rate limits.
+        Generates a response from the LLM, retrying rate limits and transient server errors.
+        Identical requests are served from an in-process LRU cache.
         """
+        try:
+            return self._generate(prompt, system_prompt, json_mode, model_tier)
+        except Exception as e:
+            logger.error("Ошибка при генерации ответа: %s", e)
+            return f"Ошибка: {e}"
+
+    def _generate(self, prompt: str, system_prompt: str, json_mode: bool = False,
+                  model_tier: str = "strong") -> str:
+        """generate_response that raises on failure instead of returning the error text."""
+        key = self._cache_key(prompt, system_prompt, json_mode, model_tier)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+
         messages = [SystemMessage(content=system_prompt), HumanMessage(content=prompt)]
+        invoke_kwargs = self._json_kwargs if json_mode else {}
+        client = self.fast_client if model_tier == "fast" else self.client
 
-        current_delay = 2.0
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                # Remove max_tokens argument to let the model generate until it stops naturally
-                response = self.client.invoke(messages)
-                return response.content
-            except Exception as e:
-                error_str = str(e)
-                if ("429" in error_str or "Too Many Requests" in error_str) and attempt < max_retries - 1:
-                    print(f"Превышен лимит запросов (429). Ожидание {current_delay} сек... (Попытка {attempt + 1}/{max_retries})")
-                    time.sleep(current_delay)
-                    current_delay *= 2  # Exponential backoff
-                    continue
-                print(f"Ошибка при генерации ответа: {e}")
-                return f"Ошибка: {e}"
-        return "Ошибка: Превышено количество попыток."
-
-    def simple_chat(self, user_query: str, context: str, history: list = None) -> dict:
+        # Remove max_tokens argument to let the model generate until it stops naturally
+        response = Retrying(**_retry_policy())(client.invoke, messages, **invoke_kwargs)
+        self._cache_put(key, response.content)
+        return response.content
+
+    def stream_response(self, prompt: str, system_prompt: str = "Ты полезный ИИ-ассистент."):
+        """
+        Yields the response text piece by piece as the model generates it, so the
+        user sees the start of a long answer immediately. The full text is cached
+        like generate_response; a cached answer is yielded in one piece.
+        On failure the error text is yielded as the last piece and the exception is
+        re-raised, so callers can tell a truncated answer from a complete one.
+        """
+        key = self._cache_key(prompt, system_prompt, False)
+        cached = self._cache_get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        messages = [SystemMessage(content=system_prompt), HumanMessage(content=prompt)]
+
+        pieces = []
+        # Only retry before anything was shown, otherwise the text would repeat
+        policy = _retry_policy(retry_if_exception(lambda e: not pieces and _is_retryable(e)))
+        try:
+            if not hasattr(self.client, "stream"):
+                yield self._generate(prompt, system_prompt)
+                return
+            for attempt in Retrying(**policy):
+                with attempt:
+                    for chunk in self.client.stream(messages):
+                        if chunk.content:
+                            pieces.append(chunk.content)
+                            yield chunk.content
+            if not pieces:
+                # Servers that ignore stream=True answer with one plain JSON body, which the
+                # event-stream decoder reads as no chunks: ask again without streaming
+                yield self._generate(prompt, system_prompt)
+                return
+        except Exception as e:
+            logger.error("Ошибка при генерации ответа: %s", e)
+            yield f"Ошибка: {e}"
+            raise
+        self._cache_put(key, "".join(pieces))
+
+    async def agenerate_response(
+        self,
+        prompt: str,
+        system_prompt: str = "Ты полезный ИИ-ассистент.",
+        json_mode: bool = False,
+        model_tier: str = "strong",
+    ) -> str:
+        """
+        Async counterpart of generate_response (same cache and retry policy).
+        Clients without a native ainvoke run the blocking call in a worker thread.
+        """
+        key = self._cache_key(prompt, system_prompt, json_mode, model_tier)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+
+        messages = [SystemMessage(content=system_prompt), HumanMessage(content=prompt)]
+        invoke_kwargs = self._json_kwargs if json_mode else {}
+        client = self.fast_client if model_tier == "fast" else self.client
+
+        retrying = AsyncRetrying(**_retry_policy())
+        try:
+            if hasattr(client, "ainvoke"):
+                response = await retrying(client.ainvoke, messages, **invoke_kwargs)
+            else:
+                response = await retrying(asyncio.to_thread, client.invoke, messages, **invoke_kwargs)
+        except Exception as e:
+            logger.error("Ошибка при генерации ответа: %s", e)
+            return f"Ошибка: {e}"
+        self._cache_put(key, response.content)
+        return response.content
+
+    async def agenerate_batch(self, requests: list) -> list:
+        """
+        Runs independent requests concurrently.
+        :param requests: list of (prompt, system_prompt, json_mode[, model_tier]) tuples.
+        :return: responses in the same order, so N calls take ~max latency instead of the sum.
+        """
+        return await asyncio.gather(*[self.agenerate_response(*request) for request in requests])
+
+    def generate_batch(self, requests: list) -> list:
+        """Sync wrapper over agenerate_batch; falls back to sequential calls inside a running event loop."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Async HTTP pools are bound to the loop that opened their connections, so all
+            # batches run on one long-lived loop instead of a fresh asyncio.run() loop each
+            if self._batch_loop is None:
+                self._batch_loop = asyncio.new_event_loop()
+            return self._batch_loop.run_until_complete(self.agenerate_batch(requests))
+        return [self.generate_response(*request) for request in requests]
+
+    def _embed_query(self, text: str):
+        """Normalised query embedding from the RAG model, or None if it is unavailable."""
+        if not self._cache_enabled or not self.rag_manager or getattr(self.rag_manager, "model", None) is None:
+            return None
+        try:
+            # Shares the per-turn cache with retrieval of the same question
+            return self.rag_manager.embed_query(text)
+        except Exception:
+            return None
+
+    def _semantic_lookup(self, query_vec, context_hash: str, sources: tuple):
+        """
+        Returns a cached knowledge-base answer for a near-identical question asked in the
+        same data context that retrieved the same documents.
+        """
+        if query_vec is None or self._semantic_vectors is None or self._cache_overwrite:
+            return None
+        scores = self._semantic_vectors @ query_vec
+        for idx in np.argsort(scores)[::-1]:
+            if scores[idx] < self._semantic_threshold:
+                break
+            cached_hash, cached_sources, response = self._semantic_entries[idx]
+            if cached_hash == context_hash and cached_sources == sources:
+                return dict(response)
+        return None
+
+    def _semantic_store(self, query_vec, context_hash: str, sources: tuple, response: dict):
+        if query_vec is None:
+            return
+        row = query_vec[None, :]
+        self._semantic_vectors = row if self._semantic_vectors is None else np.vstack([self._semantic_vectors, row])
+        self._semantic_entries.append((context_hash, sources, dict(response)))
+
+    def simple_chat(self, user_query: str, context: str, history: list = None, on_token=None) -> dict:
         """
         Smart Router chat: answers directly or signals that code is needed.
+        If on_token is given, a knowledge-base answer is streamed through it as it is
+        generated and the result is marked with "streamed": True.
         Returns dict: {"answer": str | None, "needs_code": bool}
         """
-        import json
-
-        system_prompt = (
-            "Ты — Эксперт-консультант по Process Mining с доступом к данным и базе знаний о платформе.\n"
-            "ПРАВИЛА:\n"
-            "1. Если вопрос касается ФУНКЦИОНАЛА ПЛАТФОРМЫ (как строить графики, как запустить ML, "
-            "как удалять данные, интерфейс, настройки) — верни needs_rag: true.\n"
-            "2. Если вопрос требует РАСЧЕТОВ по текущему датасету (среднее, медиана, фильтрация, топ-N) "
-            "— верни needs_code: true.\n"
-            "3. Отвечай на простые вопросы о структуре данных напрямую, если расчет не требуется.\n"
-            "4. Формат ответа СТРОГО JSON.\n"
-            "\n"
-            "ФОРМАТ ОТВЕТА:\n"
-            '{"answer": "Текст (если не нужен RAG/код)", "needs_code": false, "needs_rag": false}\n'
-            "Если нужен расчет:\n"
-            '{"answer": null, "needs_code": true, "needs_rag": false}\n'
-            "Если вопрос про инструкцию/платформу:\n"
-            '{"answer": null, "needs_code": false, "needs_rag": true}\n'
-        )
-
-        # Keyword detection for platform/instructions
-        platform_keywords = [
-            "как", "инструкция", "руководство", "платформа", "интерфейс", 
-            "настройк", "ml модель", "кластеризация", "удалит", "создать"
-        ]
-        
-        # Check for RAG intent first manually as a fallback/accelerator
-        if any(kw in user_query.lower() for kw in platform_keywords) and self.rag_manager:
-            # Let's see if LLM confirms or just use it
-            pass
+        system_prompt = _SYS_ROUTER
 
-        prompt_parts = [f"КОНТЕКСТ ДАННЫХ:\n{context}"]
+        prompt_parts = [f"КОНТЕКСТ ДАННЫХ:\n{_truncate(context, _MAX_CONTEXT_CHARS)}"]
         if history:
             prompt_parts.append("\nИСТОРИЯ ДИАЛОГА:")
-            for msg in history[-10:]:
-                role = "Пользователь" if msg["role"] == "user" else "Ассистент"
-                prompt_parts.append(f"{role}: {msg['text']}")
+            prompt_parts.extend(_format_history(history, 10))
         prompt_parts.append(f"\nВОПРОС ПОЛЬЗОВАТЕЛЯ:\n{user_query}")
         prompt = "\n".join(prompt_parts)
 
@@ -168,6 +666,17 @@ class LLMClient:
                     for d in docs:
                         print(f"   -> [{d['score']:.3f}] {d['title']}")
 
+                    # Knowledge-base answers do not depend on the dialogue, so a paraphrase of an
+                    # earlier platform question in the same data context is answered from cache.
+                    # The query embedding is the one retrieval just computed (per-turn cache)
+                    context_hash = hashlib.sha256(context.encode("utf-8")).hexdigest()
+                    sources = tuple(d["path"] for d in docs)
+                    query_vec = self._embed_query(user_query)
+                    cached = self._semantic_lookup(query_vec, context_hash, sources)
+                    if cached is not None:
+                        print("📚 Ответ из кэша базы знаний.")
+                        return cached
+
                     doc_context = "\n\n".join([d["formatted"] for d in docs])
                     source_paths = "\n".join([f"  - {d['path']}" for d in docs])
 
@@ -180,12 +689,29 @@ class LLMClient:
                         f"ВОПРОС: {user_query}\n\n"
                         f"ИСТОЧНИКИ:\n{source_paths}"
                     )
-                    rag_answer = self.generate_response(
-                        rag_prompt,
-                        "Ты технический писатель Платформы Process Mining. "
-                        "Отвечай структурированно и по существу."
-                    )
-                    return {"answer": rag_answer, "needs_code": False, "needs_rag": True}
+                    # Only an answer that completed without an error is reused for later questions
+                    answered = False
+                    pieces = []
+                    try:
+                        if on_token is None:
+                            pieces.append(self._generate(rag_prompt, _SYS_RAG_ANSWER))
+                        else:
+                            for piece in self.stream_response(rag_prompt, _SYS_RAG_ANSWER):
+                                on_token(piece)
+                                pieces.append(piece)
+                        answered = True
+                    except Exception as e:
+                        # stream_response has already logged and yielded the error text
+                        if on_token is None:
+                            logger.error("Ошибка при генерации ответа: %s", e)
+                            pieces.append(f"Ошибка: {e}")
+                    rag_answer = "".join(pieces)
+                    response = {"answer": rag_answer, "needs_code": False, "needs_rag": True}
+                    if answered and rag_answer:
+                        self._semantic_store(query_vec, context_hash, sources, response)
+                    if on_token is not None:
+                        response = dict(response, streamed=True)
+                    return response
                 else:
                     return {
                         "answer": "К сожалению, в базе знаний нет информации по вашему вопросу.",
@@ -208,61 +734,14 @@ class LLMClient:
         Generates pandas code to answer the user's question.
         Returns: {"thought": str, "code": str}
         """
-        import json
-
         context = context or {}
         error_context = ""
         if previous_error:
             error_context = f"\n\nПРЕДЫДУЩАЯ ПОПЫТКА ЗАВЕРШИЛАСЬ ОШИБКОЙ:\n{previous_error}\nИСПРАВЬ КОД!\n"
 
-        system_prompt = (
-            "Ты — Эксперт по анализу данных. Твоя задача — написать pandas-код для ответа на вопрос пользователя.\n"
-            "\n"
-            "ДОСТУПНЫЕ ПЕРЕМЕННЫЕ:\n"
-            "- df: pandas DataFrame с данными (Process Mining Event Log)\n"
-            "- pd: pandas библиотека\n"
-            "- np: numpy библиотека\n"
-            "- plt: matplotlib.pyplot для визуализации\n"
-            "\n"
-            "ТЕРМИНОЛОГИЯ PROCESS MINING:\n"
-            "- АКТИВНОСТЬ (Activity) = Событие, строка в логе.\n"
-            "- ПУТЬ/ТРЕЙС (Trace, Variant) = ПОСЛЕДОВАТЕЛЬНОСТЬ активностей для одного case_id.\n"
-            "  Для анализа путей собери их в СТРОКУ: .apply(lambda x: ' -> '.join(x)).\n"
-            "\n"
-            "ПРАВИЛА:\n"
-            "1. ОБЯЗАТЕЛЬНО сохрани финальный результат в переменную 'result'.\n"
-            "2. Код должен быть простым и читаемым.\n"
-            "3. Используй только pandas/numpy/matplotlib операции.\n"
-            "4. ВИЗУАЛИЗАЦИЯ: Если нужен график, сохрани его через `plt.savefig('reports/temp_plot.png')` и установи `result = 'reports/temp_plot.png'`.\n"
-            "5. 'result' должен быть стандартным Python типом (int, float, dict, list, str). Используй .item() для numpy скаляров.\n"
-            "6. Результат должен быть JSON-сериализуемым.\n"
-            "\n"
-            "ПРИМЕРЫ (Few-Shot):\n"
-            "Вопрос: Сколько всего уникальных кейсов?\n"
-            "Код: result = df['case_id'].nunique()\n\n"
-            "Вопрос: Найди топ-5 самых частых активностей.\n"
-            "Код: result = df['activity'].value_counts().head(5).to_dict()\n\n"
-            "Вопрос: Построй график распределения длительности кейсов.\n"
-            "Код:\n"
-            "durations = df.groupby('case_id')['timestamp'].agg(lambda x: (x.max() - x.min()).total_seconds() / 3600)\n"
-            "plt.figure(figsize=(10,6))\n"
-            "durations.hist(bins=20)\n"
-            "plt.title('Распределение длительности кейсов (часы)')\n"
-            "plt.savefig('reports/temp_plot.png')\n"
-            "result = 'reports/temp_plot.png'\n"
-            "\n"
-            "7. БЕЗОПАСНАЯ СОРТИРОВКА (LINUX FIX): Если нужно сортировать по колонке с датой, ВСЕГДА используй промежуточный pd.to_numeric(pd.to_datetime(..., errors='coerce')).\n"
-            "   Пример: df.assign(ts_int=pd.to_numeric(pd.to_datetime(df['timestamp'], errors='coerce'))).sort_values(['case_id', 'ts_int']).drop(columns='ts_int')\n"
-            "8. НЕ ПЕРЕКОНВЕРТИРУЙ: Даты уже в формате datetime64[ns]. Не вызывай pd.to_datetime() повторно.\n"
-            "9. ЯДЕРНЫЙ ПЕРЕВОД В ЧИСЛА (LINUX FIX): Если нужны инты из дат, ВСЕГДА делай pd.to_numeric(pd.to_datetime(df['ts'], errors='coerce')).fillna(0).astype('int64'). Это защищает от object-массивов с NaT.\n"
-            + error_context
-            + "\n"
-            "ФОРМАТ ОТВЕТА (JSON):\n"
-            "{\n"
-            '  "thought": "Рассуждение: что нужно сделать и как",\n'
-            '  "code": "result = df..."\n'
-            "}"
-        )
+        # The system prompt stays fully static; per-attempt errors go at the end of the
+        # user prompt, after the session-stable data description
+        system_prompt = _SYS_PANDAS_CODE
 
         user_prompt = (
             f"ИНФОРМАЦИЯ О ДАННЫХ:\n{df_info}\n\n"
@@ -276,35 +755,21 @@ class LLMClient:
             return parsed
 
         # Fallback 1: Extract "code" field directly via regex (handles malformed JSON with raw newlines)
-        import re
-        code_match = re.search(r'"code"\s*:\s*"((?:[^"\\]|\\.)*)"', response_str, re.DOTALL)
+        code_match = _CODE_FIELD_RE.search(response_str)
         if code_match:
             code = code_match.group(1).replace('\\n', '\n').replace('\\t', '\t').replace('\\"', '"')
             # Also try to extract thought
-            thought_match = re.search(r'"thought"\s*:\s*"((?:[^"\\]|\\.)*)"', response_str, re.DOTALL)
+            thought_match = _THOUGHT_FIELD_RE.search(response_str)
             thought = thought_match.group(1) if thought_match else "Извлечено regex"
             return {"thought": thought, "code": code}
 
-        # Fallback 2: Extract JSON from markdown code fence (```json ... ```)
-        for fence_lang in ["```json", "```"]:
-            if fence_lang in response_str:
-                try:
-                    json_block = response_str.split(fence_lang, 1)[1].split("```", 1)[0].strip()
-                    inner_parsed = self._parse_json(json_block)
-                    if inner_parsed and "code" in inner_parsed:
-                        return inner_parsed
-                except (IndexError, Exception):
-                    pass
-
-        # Fallback 3: Extract python code from markdown block
-        if "```python" in response_str:
-            try:
-                code_block = response_str.split("```python")[1].split("```")[0].strip()
-                return {"thought": "Извлечено из markdown блока", "code": code_block}
-            except IndexError:
-                pass
+        # Fallback 2: Extract python code from markdown block
+        # (JSON inside ```json fences is already handled by _parse_json above)
+        python_fence = _PYTHON_FENCE_RE.search(response_str)
+        if python_fence:
+            return {"thought": "Извлечено из markdown блока", "code": python_fence.group(1).strip()}
 
-        # Fallback 4: Direct code assignment
+        # Fallback 3: Direct code assignment
         if "result =" in response_str:
             return {"thought": "Извлечено прямым текстом", "code": response_str.strip()}
 
@@ -314,36 +779,39 @@ class LLMClient:
         """
         Verifies if the result adequately answers the question considering chat history.
         """
-        system_prompt = (
-            "Ты — строгий ИИ-Судья. Твоя задача — проверить, является ли результат выполнения кода КАЧЕСТВЕННЫМ ответом на вопрос.\n"
-            "\n"
-            "КРИТЕРИИ ПРОВЕРКИ:\n"
-            "1. ПОЛНОТА: Содержит ли результат все запрашиваемые данные?\n"
-            "2. РЕЛЕВАНТНОСТЬ: Соответствует ли ответ смыслу вопроса и контексту диалога?\n"
-            "3. ПРАВДОПОДОБНОСТЬ: Не выглядит ли результат заведомо ошибочным (например, пустой список там, где точно должны быть данные)?\n"
-            "\n"
-            "СПЕЦИАЛЬНЫЕ ПРАВИЛА:\n"
-            "- Если результат — путь к файлу (например, 'reports/temp_plot.png'), считай это валидным графиком.\n"
-            "- Если пользователь спросил 'Топ 10', а в результате 0 или 1 элемент без объяснения причин — это is_valid: false.\n"
-            "\n"
-            "ФОРМАТ ОТВЕТА (JSON):\n"
-            "{\n"
-            '  "is_valid": true | false,\n'
-            '  "critique": "Краткое описание проблемы, если есть",\n'
-            '  "suggestion": "Как исправить код, чтобы получить верный результат"\n'
-            "}\n"
-        )
+        verified = self._verify_file_result(result_str)
+        if verified is not None:
+            return verified
+        user_prompt, system_prompt = self._verify_prompts(question, result_str, history)
+        response_str = self.generate_response(user_prompt, system_prompt, json_mode=True, model_tier="fast")
+        return self._parse_verification(response_str)
+
+    @staticmethod
+    def _verify_file_result(result_str) -> dict:
+        """
+        A plot path that exists on disk is valid by the verifier's own rules,
+        so it is accepted without an LLM round-trip. Returns None otherwise.
+        """
+        path = str(result_str).strip()
+        if path.endswith(".png") and os.path.isfile(path):
+            return {"is_valid": True, "critique": "", "suggestion": ""}
+        return None
+
+    def _verify_prompts(self, question: str, result_str: str, history: list = None) -> tuple:
+        system_prompt = _SYS_VERIFY
 
         prompt_parts = []
         if history:
             prompt_parts.append("ИСТОРИЯ ДИАЛОГА:")
-            for msg in history[-5:]:
-                role = "Пользователь" if msg["role"] == "user" else "Ассистент"
-                prompt_parts.append(f"{role}: {msg['text']}")
+            prompt_parts.extend(_format_history(history, 5))
         
-        prompt_parts.append(f"\nВОПРОС: {question}\n\nРЕЗУЛЬТАТ КОДА:\n{result_str}")
+        prompt_parts.append(
+            f"\nВОПРОС: {question}\n\nРЕЗУЛЬТАТ КОДА:\n{_truncate(str(result_str), _MAX_RESULT_CHARS)}"
+        )
         user_prompt = "\n".join(prompt_parts)
-        response_str = self.generate_response(user_prompt, system_prompt, json_mode=True)
+        return user_prompt, system_prompt
+
+    def _parse_verification(self, response_str: str) -> dict:
         parsed = self._parse_json(response_str)
         if parsed:
             return parsed
@@ -359,25 +827,49 @@ class LLMClient:
         Interprets code execution result into a human-friendly answer.
         Returns: {"answer": str}
         """
-        system_prompt = (
-            "Ты — Эксперт-консультант по Process Mining.\n"
-            "Преврати результат выполнения кода в понятный ответ на русском языке.\n"
-            "НИКОГДА НЕ ВЫДУМЫВАЙ ЦИФРЫ. Используй ТОЛЬКО факты из результата.\n"
-            "Формат ответа: JSON {\"answer\": \"...\"}"
-        )
+        user_prompt, system_prompt = self._interpret_prompts(question, result, result_type)
+        response_str = self.generate_response(user_prompt, system_prompt, json_mode=True, model_tier="fast")
+        return self._parse_interpretation(response_str, result)
+
+    def _interpret_prompts(self, question: str, result: str, result_type: str) -> tuple:
+        system_prompt = _SYS_INTERPRET_CODE
 
         user_prompt = (
             f"ВОПРОС ПОЛЬЗОВАТЕЛЯ:\n{question}\n\n"
-            f"РЕЗУЛЬТАТ КОДА (тип: {result_type}):\n{result}"
+            f"РЕЗУЛЬТАТ КОДА (тип: {result_type}):\n{_truncate(str(result), _MAX_RESULT_CHARS)}"
         )
 
         if str(result).endswith('.png'):
             user_prompt += "\n\nПРИМЕЧАНИЕ: Результат — это путь к созданному графику. Обязательно упомяни, что график построен и доступен по ссылке."
 
-        response_str = self.generate_response(user_prompt, system_prompt, json_mode=True)
+        return user_prompt, system_prompt
+
+    def _parse_interpretation(self, response_str: str, result) -> dict:
         parsed = self._parse_json(response_str)
         if parsed:
             return parsed
 
         return {"answer": str(result)}
 
+    def verify_and_interpret(
+        self, question: str, result, result_type: str, history: list = None
+    ) -> tuple:
+        """
+        Runs verification and interpretation of a code result concurrently.
+        Both depend only on the result, so the interpretation is requested speculatively
+        and simply discarded by the caller if verification fails.
+        Returns: (verification dict, interpretation dict)
+        """
+        interp_prompt, interp_system = self._interpret_prompts(question, result, result_type)
+        verified = self._verify_file_result(result)
+        if verified is not None:
+            interp_str = self.generate_response(interp_prompt, interp_system, json_mode=True, model_tier="fast")
+            return verified, self._parse_interpretation(interp_str, result)
+
+        verify_prompt, verify_system = self._verify_prompts(question, result, history)
+        verify_str, interp_str = self.generate_batch([
+            (verify_prompt, verify_system, True, "fast"),
+            (interp_prompt, interp_system, True, "fast"),
+        ])
+        return self._parse_verification(verify_str), self._parse_interpretation(interp_str, result)
+
@@ -1,12 +1,18 @@
 import argparse
-import json
+import contextlib
+import logging
+import orjson
 import pandas as pd
 import sys
 import os
+import re
+import time
+import traceback
 import warnings
-import pm4py
 import csv
-from datetime import datetime
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 # Suppress warnings
 warnings.filterwarnings("ignore")
@@ -18,12 +24,22 @@ if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
 from pm_agent.llm import LLMClient
-from pm_agent.agents.formatter import DataFormatterAgent
-from pm_agent.agents.deviation_detector import DeviationDetectorAgent
+from pm_agent.io_writer import writer
 from pm_agent.safe_executor import execute_pandas_code, validate_code_syntax, get_df_info_for_llm
-from pm_agent.rag_manager import RAGManager
 from pm_agent.config import RAG_DOC_DIR, RAG_MODEL_PATH
 
+logger = logging.getLogger("pm_agent")
+
+# Enables multithreaded CSV parsing and Feather session files (in requirements.txt;
+# without it sessions fall back to CSV)
+_HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+# Questions containing any of these words are sent straight to the Code Interpreter
+_CALC_KEYWORDS_RE = re.compile("|".join(map(re.escape, [
+    "сколько", "посчитай", "вычисли", "найди", "покажи",
+    "среднее", "медиана", "топ", "процент", "сумма",
+])))
+
 
 # ---------------------------------------------------------------------------
 #  Console helpers
@@ -31,14 +47,12 @@ from pm_agent.config import RAG_DOC_DIR, RAG_MODEL_PATH
 
 def robust_input(prompt: str) -> str:
     """Reads input safely, handling encoding issues in non-UTF-8 terminals."""
-    import sys
     try:
         # Try to reconfigure stdin if possible (Python 3.7+)
         if hasattr(sys.stdin, 'reconfigure'):
-            try:
+            # io.UnsupportedOperation (an OSError/ValueError) for detached or non-text streams
+            with contextlib.suppress(OSError, ValueError):
                 sys.stdin.reconfigure(encoding='utf-8', errors='replace')
-            except Exception:
-                pass
         return input(prompt)
     except UnicodeDecodeError:
         sys.stdout.write(prompt)
@@ -58,50 +72,122 @@ def robust_input(prompt: str) -> str:
 #  Session helpers
 # ---------------------------------------------------------------------------
 
-def get_session_dir(file_path: str) -> str:
+def get_session_dir(file_path: str) -> Path:
     """Returns the session directory for a given dataset file."""
-    basename = os.path.splitext(os.path.basename(file_path))[0]
-    return os.path.join("reports", basename)
+    return Path("reports") / Path(file_path).stem
 
 
-def save_session(session_dir: str, df: pd.DataFrame, column_roles: dict, file_path: str, findings_summary: str):
+def save_session(session_dir: Path, df: pd.DataFrame, column_roles: dict, file_path: str, findings_summary: str):
     """Saves formatted data and column roles to disk."""
-    os.makedirs(session_dir, exist_ok=True)
+    session_dir.mkdir(parents=True, exist_ok=True)
 
-    # Save formatted data
-    df.to_csv(os.path.join(session_dir, "formatted_data.csv"), index=False)
+    # Save formatted data (binary, so the formatter's dtypes survive a resume)
+    _write_session_frame(session_dir, df)
 
     # Save session metadata
     session_meta = {
         "column_roles": column_roles,
         "source_file": os.path.abspath(file_path),
-        "saved_at": datetime.now().strftime("%d.%m.%Y %H:%M"),
+        "saved_at": time.strftime("%d.%m.%Y %H:%M"),
         "rows": len(df),
         "columns": len(df.columns),
         "findings_summary": findings_summary
     }
-    with open(os.path.join(session_dir, "session.json"), "w", encoding="utf-8") as f:
-        json.dump(session_meta, f, ensure_ascii=False, indent=2)
+    (session_dir / "session.json").write_bytes(orjson.dumps(session_meta, option=orjson.OPT_INDENT_2))
 
     print(f"💾 Session saved to {session_dir}/")
 
 
-def load_session(session_dir: str):
+def load_session(session_dir: Path):
     """
     Tries to load a previous session.
     Returns (df, column_roles, meta) or None.
     """
-    session_path = os.path.join(session_dir, "session.json")
-    data_path = os.path.join(session_dir, "formatted_data.csv")
+    session_path = session_dir / "session.json"
+    if not session_path.exists():
+        return None
 
-    if not os.path.exists(session_path) or not os.path.exists(data_path):
+    df = _read_session_frame(session_dir)
+    if df is None:
         return None
 
-    with open(session_path, "r", encoding="utf-8") as f:
-        meta = json.load(f)
+    try:
+        meta = orjson.loads(session_path.read_bytes())
+        return df, meta["column_roles"], meta
+    except (OSError, orjson.JSONDecodeError, KeyError, TypeError) as e:
+        logger.warning("⚠️ Сохранённая сессия повреждена, анализ будет выполнен заново: %s", e)
+        return None
+
+
+# Session data files in order of preference; CSV is what older sessions were saved as
+_SESSION_FRAME_FILES = (
+    ("formatted_data.feather", pd.read_feather),
+    ("formatted_data.csv", pd.read_csv),
+)
+# Written by earlier versions; removed on the next save and never read back
+_LEGACY_SESSION_FILES = ("formatted_data.pkl",)
+
+
+def _write_session_frame(session_dir: Path, df: pd.DataFrame):
+    """Writes df as Feather (LZ4) when pyarrow is installed, otherwise as CSV."""
+    frame = df.reset_index(drop=True)
+    target = None
+    if _HAS_PYARROW:
+        try:
+            frame.to_feather(session_dir / "formatted_data.feather", compression="lz4")
+            target = session_dir / "formatted_data.feather"
+        except Exception:
+            # Columns Arrow cannot represent (e.g. mixed-type objects) - fall back to CSV
+            pass
+    if target is None:
+        target = session_dir / "formatted_data.csv"
+        frame.to_csv(target, index=False)
+
+    # Drop files from other formats so a stale copy is never picked up on resume
+    for name in [name for name, _ in _SESSION_FRAME_FILES] + list(_LEGACY_SESSION_FILES):
+        if name != target.name:
+            (session_dir / name).unlink(missing_ok=True)
+
+
+def _read_session_frame(session_dir: Path):
+    """Returns the saved frame, or None if there is none or it cannot be read."""
+    for name, reader in _SESSION_FRAME_FILES:
+        path = session_dir / name
+        if not path.exists():
+            continue
+        try:
+            return reader(path)
+        except Exception as e:
+            # Missing pyarrow, a truncated file, a version mismatch - treat as no session
+            logger.warning("⚠️ Не удалось прочитать %s: %s", path, e)
+            return None
+    return None
 
-    df = pd.read_csv(data_path)
-    return df, meta["column_roles"], meta
+
+def load_chat_history(session_dir: Path) -> list:
+    """
+    Reads chat_history.jsonl (one message per line). A chat_history.json from older
+    sessions is converted once, after which turns are only appended.
+    """
+    jsonl_path = session_dir / "chat_history.jsonl"
+    if jsonl_path.exists():
+        lines = jsonl_path.read_bytes().splitlines()
+        history = []
+        for line in lines:
+            # A torn last line (crash mid-append) is skipped instead of losing the session
+            with contextlib.suppress(orjson.JSONDecodeError):
+                history.append(orjson.loads(line))
+        if len(history) != len(lines):
+            # Rewrite without it, so the next append starts on a clean line
+            jsonl_path.write_bytes(b"".join(orjson.dumps(msg) + b"\n" for msg in history))
+        return history
+
+    legacy_path = session_dir / "chat_history.json"
+    if legacy_path.exists():
+        history = orjson.loads(legacy_path.read_bytes())
+        jsonl_path.write_bytes(b"".join(orjson.dumps(msg) + b"\n" for msg in history))
+        return history
+    return []
 
 
 # ---------------------------------------------------------------------------
@@ -185,7 +271,7 @@ def map_columns(df: pd.DataFrame) -> dict:
 #  Report
 # ---------------------------------------------------------------------------
 
-def generate_report(session_dir: str, df: pd.DataFrame, column_roles: dict, findings_summary: str):
+def generate_report(session_dir: Path, df: pd.DataFrame, column_roles: dict, findings_summary: str):
     """Generates and saves a basic PM report."""
     rows = len(df)
     cols = len(df.columns)
@@ -204,14 +290,36 @@ def generate_report(session_dir: str, df: pd.DataFrame, column_roles: dict, find
         f"{findings_summary}\n"
     )
 
-    report_path = os.path.join(session_dir, "report.md")
-    with open(report_path, "w", encoding="utf-8") as f:
-        f.write(report_content)
+    report_path = session_dir / "report.md"
+
+    # On a resumed session the report is usually identical - skip rewriting it
+    existing_content = None
+    if report_path.exists():
+        existing_content = report_path.read_text(encoding="utf-8")
 
-    print(f"\n📄 Report saved to {report_path}")
+    write_future = None
+    if existing_content == report_content:
+        print(f"\n📄 Report is up to date: {report_path}")
+    else:
+        # Write the file in the background while the preview is printed
+        executor = ThreadPoolExecutor(max_workers=1)
+        write_future = executor.submit(report_path.write_text, report_content, encoding="utf-8")
+        executor.shutdown(wait=False)
     print("\n--- REPORT PREVIEW ---")
     print(report_content)
     print("----------------------")
+    if write_future is not None:
+        write_future.result()
+        print(f"\n📄 Report saved to {report_path}")
+
+
+def sniff_delimiter(file_path: str, encoding: str) -> str:
+    """Detects the CSV delimiter from the first non-empty line."""
+    with open(file_path, "r", encoding=encoding, newline="") as f:
+        for line in f:
+            if line.strip():
+                return csv.Sniffer().sniff(line).delimiter
+    raise csv.Error("Empty file")
 
 
 def load_csv_robustly(file_path: str) -> pd.DataFrame:
@@ -222,8 +330,20 @@ def load_csv_robustly(file_path: str) -> pd.DataFrame:
     
     for enc in encodings:
         try:
-            # sep=None and engine='python' enable automatic delimiter detection
-            return pd.read_csv(file_path, sep=None, engine='python', encoding=enc)
+            # Sniff the delimiter from the first line (what sep=None does) and parse with
+            # pyarrow's multithreaded reader when available, then the C engine; fall back
+            # to the python engine for files they reject
+            try:
+                sep = sniff_delimiter(file_path, enc)
+                if _HAS_PYARROW:
+                    try:
+                        return pd.read_csv(file_path, sep=sep, encoding=enc, engine='pyarrow')
+                    except Exception:
+                        # e.g. invalid bytes for enc or ragged rows - let the C engine decide
+                        pass
+                return pd.read_csv(file_path, sep=sep, encoding=enc)
+            except (csv.Error, pd.errors.ParserError):
+                return pd.read_csv(file_path, sep=None, engine='python', encoding=enc)
         except (UnicodeDecodeError, UnicodeError) as e:
             last_err = e
             continue
@@ -236,17 +356,49 @@ def load_csv_robustly(file_path: str) -> pd.DataFrame:
     return pd.DataFrame()
 
 
+def init_rag():
+    """
+    Loads the RAG knowledge base; returns None if it is unavailable.
+    Runs while the column-mapping prompts are open, so it only logs at DEBUG level.
+    """
+    if not os.path.exists(RAG_MODEL_PATH):
+        logger.debug("RAG model not found at %s, skipping RAG.", RAG_MODEL_PATH)
+        return None
+    try:
+        # Imported here: torch/sentence-transformers take seconds to load, and this
+        # runs on the background RAG thread
+        from pm_agent.rag_manager import RAGManager
+        return RAGManager(RAG_DOC_DIR, RAG_MODEL_PATH)
+    except Exception as e:
+        logger.debug("RAG Initialization failed: %s", e)
+        return None
+
+
 def main():
     parser = argparse.ArgumentParser(description="AutoPM Agent")
     parser.add_argument("--file", type=str, help="Path to event log file")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the LLM response cache")
+    parser.add_argument("--cache-overwrite", action="store_true",
+                        help="Ignore cached LLM responses but store fresh ones")
+    parser.add_argument("--quiet", action="store_true", help="Only log warnings and errors")
     args = parser.parse_args()
 
+    # Diagnostics go through logging; set AUTOPM_LOG_LEVEL=DEBUG for verbose output
+    level_name = "WARNING" if args.quiet else os.environ.get("AUTOPM_LOG_LEVEL", "INFO").upper()
+    log_level = getattr(logging, level_name, None)
+    logging.basicConfig(level=log_level if isinstance(log_level, int) else logging.INFO,
+                        format="%(message)s")
+    # faiss logs its CPU-feature probing at INFO when imported on the RAG thread
+    logging.getLogger("faiss").setLevel(max(logging.WARNING, logging.root.level))
+    if not isinstance(log_level, int):
+        logger.warning("⚠️ Неизвестный уровень AUTOPM_LOG_LEVEL=%s, используется INFO", level_name)
+
     print("AutoPM Agent")
     try:
         backend = pd.get_option('mode.dtype_backend')
-        print(f"DEBUG: pandas dtype_backend = {backend}")
+        logger.debug("pandas dtype_backend = %s", backend)
     except Exception:
-        print("DEBUG: pandas dtype_backend = NOT_AVAILABLE")
+        logger.debug("pandas dtype_backend = NOT_AVAILABLE")
 
     # 1. Get file path (FIRST!)
     file_path = args.file
@@ -269,25 +421,26 @@ def main():
               f"Activity → {column_roles['activity']}, "
               f"Timestamp → {column_roles['timestamp']}")
 
-    # 3. Init RAG and LLM
+    # 3. Init RAG and LLM.
+    # Loading the embedding model and indexing the docs is only needed by the chat loop,
+    # so it runs in the background while the data is loaded, formatted and analysed.
     print("Initializing RAG Knowledge Base...")
-    rag_manager = None
-    if os.path.exists(RAG_MODEL_PATH):
-        try:
-            rag_manager = RAGManager(RAG_DOC_DIR, RAG_MODEL_PATH)
-        except Exception as e:
-            print(f"⚠️ RAG Initialization failed: {e}")
-    else:
-        print(f"ℹ️ RAG model not found at {RAG_MODEL_PATH}, skipping RAG.")
+    rag_executor = ThreadPoolExecutor(max_workers=1)
+    rag_future = rag_executor.submit(init_rag)
+    rag_executor.shutdown(wait=False)
 
     print("Connecting to LLM...")
     try:
-        llm_client = LLMClient(rag_manager=rag_manager)
+        llm_client = LLMClient(use_cache=not args.no_cache, cache_overwrite=args.cache_overwrite)
     except Exception as e:
         print(f"❌ Error initializing LLM Client: {e}")
         return
 
     if not existing:
+        # Only a fresh session runs the agents, so a resumed one skips loading them (and scipy)
+        from pm_agent.agents.formatter import DataFormatterAgent
+        from pm_agent.agents.deviation_detector import DeviationDetectorAgent
+
         # 4. Load raw data
         print(f"\nLoading data from {file_path}...")
         try:
@@ -297,6 +450,7 @@ def main():
                 df = pd.read_excel(file_path)
             elif file_path.endswith('.xes') or file_path.endswith('.xes.gz'):
                 print("Using pm4py to read XES...")
+                import pm4py  # heavy (~2s); only XES input needs it at this point
                 df = pm4py.read_xes(file_path)
             else:
                 # Default attempt as CSV if extension is unknown
@@ -313,6 +467,17 @@ def main():
         # 5. Column Mapping
         column_roles = map_columns(df)
 
+        # Detection cannot run without these columns: ask again for any that do not exist
+        # before formatting spends LLM calls on the data
+        missing = [role for role, col in column_roles.items() if col not in df.columns]
+        if missing:
+            print(f"⚠️ Колонки не найдены в датасете: "
+                  f"{', '.join(str(column_roles[role]) for role in missing)}. "
+                  f"Укажите номер или имя колонки:")
+            role_names = {"case_id": "Case ID", "activity": "Activity", "timestamp": "Timestamp"}
+            for role in missing:
+                column_roles[role] = ask_column(list(df.columns), role_names[role])
+
         # 6. Format Data (Force correct types BEFORE analysis)
         print("\nFormatting data types using DataFormatter...")
         try:
@@ -342,7 +507,6 @@ def main():
             findings_summary = detector.get_summary_text()
             print("Deviation detection complete.")
         except Exception as e:
-            import traceback
             print(f"Deviation detection failed: {e}")
             traceback.print_exc()
             findings_summary = "Deviation detection was skipped or failed due to an error."
@@ -353,6 +517,13 @@ def main():
     # 9. Generate report
     generate_report(session_dir, df, column_roles, findings_summary)
 
+    # The knowledge base is first used by the chat loop
+    llm_client.rag_manager = rag_future.result()
+    if llm_client.rag_manager is not None and llm_client.rag_manager.is_ready():
+        print(f"📚 База знаний загружена (документов: {llm_client.rag_manager.index.ntotal}).")
+    else:
+        print("ℹ️ База знаний недоступна (подробности: AUTOPM_LOG_LEVEL=DEBUG).")
+
     # 10. Chat Loop with Code Interpreter
     rows = len(df)
     cols = len(df.columns)
@@ -368,22 +539,18 @@ def main():
     )
 
     # Load chat history
-    history_path = os.path.join(session_dir, "chat_history.json")
-    if os.path.exists(history_path):
-        with open(history_path, "r", encoding="utf-8") as f:
-            chat_history = json.load(f)
+    history_path = session_dir / "chat_history.jsonl"
+    chat_history = load_chat_history(session_dir)
+    if chat_history:
         print(f"\n📜 Loaded {len(chat_history)} previous messages.")
-    else:
-        chat_history = []
 
     # Prepare DataFrame info for Code Interpreter
     df_info = get_df_info_for_llm(df)
 
     # Load session errors (Global memory of past failures)
-    errors_path = os.path.join(session_dir, "session_errors.json")
-    if os.path.exists(errors_path):
-        with open(errors_path, "r", encoding="utf-8") as f:
-            session_errors = json.load(f)
+    errors_path = session_dir / "session_errors.json"
+    if errors_path.exists():
+        session_errors = orjson.loads(errors_path.read_bytes())
     else:
         session_errors = []
 
@@ -400,18 +567,32 @@ def main():
             if not user_input:
                 continue
 
-            # --- Step 1: Smart Router ---
-            print("🤔 Думаю...")
-            resp = llm_client.simple_chat(user_input, context_str, chat_history)
+            if llm_client.rag_manager is not None:
+                llm_client.rag_manager.clear_turn_cache()
+
+            # Keyword fallback: force code if question looks computational.
+            # The router's verdict would be overridden anyway, so it is not called.
+            if _CALC_KEYWORDS_RE.search(user_input.lower()):
+                resp = {"answer": None, "needs_code": True, "needs_rag": False}
+            else:
+                # --- Step 1: Smart Router ---
+                print("🤔 Думаю...")
+                # Knowledge-base answers are printed as they arrive
+                streamed_any = False
+
+                def print_token(piece):
+                    nonlocal streamed_any
+                    if not streamed_any:
+                        print("\n🤖 ", end="")
+                        streamed_any = True
+                    print(piece, end="", flush=True)
+
+                resp = llm_client.simple_chat(user_input, context_str, chat_history, on_token=print_token)
+                if streamed_any:
+                    print()
             needs_code = resp.get("needs_code", False)
             answer_text = resp.get("answer")
-
-            # Keyword fallback: force code if question looks computational
-            calc_keywords = ["сколько", "посчитай", "вычисли", "найди", "покажи",
-                             "среднее", "медиана", "топ", "процент", "сумма"]
-            if not needs_code and any(kw in user_input.lower() for kw in calc_keywords):
-                needs_code = True
-                answer_text = None
+            errors_changed = False
 
             # --- Step 2: Code Interpreter (if needed) ---
             if needs_code:
@@ -454,7 +635,7 @@ def main():
                         break
 
                     # Execute in sandbox
-                    exec_result = execute_pandas_code(code, df)
+                    exec_result = execute_pandas_code(code, df, tree=validation["tree"])
 
                     if exec_result["success"]:
                         # Display path if it's a plot
@@ -463,10 +644,11 @@ def main():
                         else:
                             print(f"✅ Результат: {exec_result['result']}")
 
-                        # Verify result (Passing history)
+                        # Verify result (Passing history) and interpret it concurrently;
+                        # the interpretation is dropped if verification fails
                         print("🔎 Самопроверка результата...")
-                        verification = llm_client.verify_result(
-                            user_input, exec_result["result"], chat_history
+                        verification, interp = llm_client.verify_and_interpret(
+                            user_input, exec_result["result"], exec_result["result_type"], chat_history
                         )
 
                         if verification.get("is_valid", True) is False:
@@ -480,40 +662,39 @@ def main():
                                 break
                             continue  # Retry
 
-                        # Interpret result
-                        interp = llm_client.interpret_code_result(
-                            user_input, exec_result["result"], exec_result["result_type"]
-                        )
                         answer_text = interp.get("answer", str(exec_result["result"]))
                         break
                     else:
                         print(f"❌ Ошибка выполнения: {exec_result['error']}")
                         previous_error = exec_result["error"]
-                        # Save to global session errors
-                        if previous_error not in session_errors:
+                        # Save to global session errors (once per distinct error, so repeats
+                        # do not crowd the last-5 window sent with every code prompt)
+                        if not any(e.endswith(f" | ERR: {previous_error}") for e in session_errors):
                             session_errors.append(f"Q: {user_input} | ERR: {previous_error}")
+                            errors_changed = True
                         
                         if attempt == MAX_CODE_ATTEMPTS - 1:
                             answer_text = f"Код не удалось выполнить. Ошибка: {exec_result['error']}"
 
             # --- Step 3: Show answer ---
-            if answer_text:
+            if answer_text and resp.get("streamed"):
+                pass  # Already printed while streaming
+            elif answer_text:
                 print(f"\n🤖 {answer_text}")
             else:
                 answer_text = "Не удалось получить ответ."
                 print(f"\n🤖 {answer_text}")
 
             # Save to history
-            chat_history.append({"role": "user", "text": user_input})
-            chat_history.append({"role": "assistant", "text": answer_text})
+            turn = [{"role": "user", "text": user_input}, {"role": "assistant", "text": answer_text}]
+            chat_history.extend(turn)
 
-            # Persist history to disk
-            with open(history_path, "w", encoding="utf-8") as f:
-                json.dump(chat_history, f, ensure_ascii=False, indent=2)
+            # Persist history to disk (append only this turn's two lines)
+            writer.append(history_path, b"".join(orjson.dumps(msg) + b"\n" for msg in turn))
             
-            # Persist errors to disk
-            with open(errors_path, "w", encoding="utf-8") as f:
-                json.dump(session_errors[-20:], f, ensure_ascii=False, indent=2)
+            # Persist errors to disk (only when this turn added any)
+            if errors_changed:
+                writer.submit(errors_path, orjson.dumps(session_errors[-20:], option=orjson.OPT_INDENT_2))
 
         except KeyboardInterrupt:
             print("\nExiting chat.")
@@ -1,20 +1,88 @@
+import hashlib
 import os
+from collections import OrderedDict
 from typing import Any, Dict, List
 
 import faiss
 import numpy as np
+import orjson
 import pandas as pd
+import torch
 from sentence_transformers import SentenceTransformer
 
+# Catalog size from which the approximate HNSW index beats an exact scan
+HNSW_MIN_DOCUMENTS = 10_000
+QUERY_CACHE_SIZE = 512
+# Stored vectors are int8 (scalar quantizer, per-dimension ranges learned from
+# the catalog): 4x less index memory/bandwidth than float32
+INDEX_QTYPE = faiss.ScalarQuantizer.QT_8bit
+INDEX_FORMAT = "sq8"
+ONNX_MODEL_FILE = "model_quantized.onnx"
+
+# Loaded encoders by (model path, device, backend): every RAGManager in the
+# process shares one copy of the weights instead of reloading them
+_MODEL_SINGLETON: Dict[tuple, Any] = {}
+
+
+class OnnxEncoder:
+    """
+    CPU encoder on ONNX-Runtime with int8 dynamic quantization.
+    Mirrors the SentenceTransformer.encode() call used below: mean pooling
+    over the attention mask, optional L2 normalisation.
+    """
+
+    def __init__(self, model_path: str, onnx_dir: str):
+        # Optional dependencies: pip install optimum[onnxruntime]
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        from transformers import AutoTokenizer
+
+        if not os.path.exists(os.path.join(onnx_dir, ONNX_MODEL_FILE)):
+            # One-time export + quantization, reused on later runs
+            print(f"Exporting {model_path} to ONNX in {onnx_dir}...")
+            if not os.path.exists(model_path) and "/" not in model_path:
+                model_path = f"sentence-transformers/{model_path}"
+            ORTModelForFeatureExtraction.from_pretrained(model_path, export=True).save_pretrained(onnx_dir)
+            AutoTokenizer.from_pretrained(model_path).save_pretrained(onnx_dir)
+            quantize_dynamic(
+                os.path.join(onnx_dir, "model.onnx"),
+                os.path.join(onnx_dir, ONNX_MODEL_FILE),
+                weight_type=QuantType.QInt8,
+            )
+
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(onnx_dir, file_name=ONNX_MODEL_FILE)
+
+    def encode(
+        self, sentences: List[str], batch_size: int = 32,
+        normalize_embeddings: bool = False, **_
+    ) -> np.ndarray:
+        chunks = []
+        for start in range(0, len(sentences), batch_size):
+            batch = self.tokenizer(
+                sentences[start:start + batch_size],
+                padding=True, truncation=True, return_tensors="np",
+            )
+            hidden = self.model(**batch).last_hidden_state
+            mask = batch["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            chunks.append(pooled.astype(np.float32, copy=False))
+        return np.concatenate(chunks) if chunks else np.empty((0, 0), dtype=np.float32)
+
 
 class RAGManager:
     def __init__(
-        self, model_name: str = "all-MiniLM-L6-v2", local_model_path: str = None
+        self, model_name: str = "all-MiniLM-L6-v2", local_model_path: str = None,
+        use_onnx: bool = False,
     ):
         """
         Initialize RAG Manager.
         :param model_name: Name of the SentenceTransformer model.
         :param local_model_path: Path to the locally saved model (for offline use).
+        :param use_onnx: Encode on CPU with an int8-quantized ONNX-Runtime export
+            of the model (exported once to models/<model_name>-onnx).
         """
         # Default local path
         default_local = os.path.join("models", model_name)
@@ -24,16 +92,34 @@ class RAGManager:
         self.model_path = local_model_path or model_name
         print(f"Loading embedding model from: {self.model_path}...")
 
-        # Auto-detect device (GPU/CPU)
-        import torch
+        if use_onnx:
+            self.device = "cpu"
+            # Quantized vectors differ slightly, so they get their own cache keys
+            self.embedding_id = self.model_path + "#onnx-int8"
+        else:
+            # Auto-detect device (GPU/CPU)
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            self.embedding_id = self.model_path
 
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        key = (self.model_path, self.device, use_onnx)
+        if key not in _MODEL_SINGLETON:
+            if use_onnx:
+                model = OnnxEncoder(self.model_path, os.path.join("models", model_name + "-onnx"))
+            else:
+                model = SentenceTransformer(self.model_path, device=self.device)
+                if self.device == "cuda":
+                    # FP16 weights halve memory traffic of the encoder forward pass
+                    model = model.half()
+            _MODEL_SINGLETON[key] = model
+        self.model = _MODEL_SINGLETON[key]
         print(f"Using device: {self.device}")
-
-        self.model = SentenceTransformer(self.model_path, device=self.device)
         self.index = None
         self.documents = []
         self.metadata = []
+        # Per-document embeddings (.npz) reused across re-indexing; set by load_excel
+        self.embedding_cache_path = None
+        # LRU of (text, top_k) -> hit indices for repeated questions; reset with the index
+        self._query_cache = OrderedDict()
 
     def load_excel(self, file_path: str):
         """
@@ -44,60 +130,206 @@ class RAGManager:
             print(f"Error: File {file_path} not found.")
             return False
 
+        source_hash = self._source_hash(file_path)
+        if self._load_saved_index(file_path, source_hash):
+            print(f"Loaded saved FAISS index for {file_path} ({len(self.documents)} documents)")
+            return True
+
+        self.embedding_cache_path = file_path + ".emb.npz"
         df = pd.read_excel(file_path)
-        self.documents = []
-        self.metadata = []
 
-        for _, row in df.iterrows():
-            proc_id = str(row.get("Process ID", ""))
-            proc_name = str(row.get("Process Name", ""))
-            description = str(row.get("Description", ""))
+        def column(name: str) -> pd.Series:
+            if name in df.columns:
+                return df[name].astype(str)
+            return pd.Series("", index=df.index)
 
-            # Combine for indexing
-            text_to_index = (
-                f"ID: {proc_id} | Name: {proc_name} | Description: {description}"
-            )
-            self.documents.append(text_to_index)
+        proc_ids = column("Process ID")
+        proc_names = column("Process Name")
+        descriptions = column("Description")
 
-            # Store metadata for retrieval
-            self.metadata.append(
-                {"id": proc_id, "name": proc_name, "description": description}
-            )
+        # Combine for indexing (whole columns at once instead of a Series per row)
+        self.documents = (
+            "ID: " + proc_ids + " | Name: " + proc_names + " | Description: " + descriptions
+        ).tolist()
+
+        # Store metadata for retrieval
+        self.metadata = [
+            {"id": proc_id, "name": proc_name, "description": description}
+            for proc_id, proc_name, description in zip(proc_ids, proc_names, descriptions)
+        ]
 
         print(f"Loaded {len(self.documents)} documents from {file_path}")
         self._initialize_index()
+        self._save_index(file_path, source_hash)
+        return True
+
+    def _source_hash(self, file_path: str) -> str:
+        """Hash of the Excel file contents and the embedding model that indexes them."""
+        with open(file_path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256")
+        digest.update(self.embedding_id.encode("utf-8"))
+        digest.update(INDEX_FORMAT.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _load_saved_index(self, file_path: str, source_hash: str) -> bool:
+        """
+        Restores the index saved next to *file_path* if it was built from the same
+        file and model. The index is memory-mapped instead of re-encoding every row.
+        """
+        index_path, meta_path = file_path + ".faiss", file_path + ".rag.json"
+        if not os.path.exists(index_path) or not os.path.exists(meta_path):
+            return False
+        try:
+            with open(meta_path, "rb") as f:
+                saved = orjson.loads(f.read())
+            if saved.get("source_hash") != source_hash:
+                return False
+            index = faiss.read_index(
+                index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+            )
+        except (OSError, RuntimeError, orjson.JSONDecodeError):
+            return False
+
+        self.index = index
+        self.documents = saved["documents"]
+        self.metadata = saved["metadata"]
+        self._query_cache.clear()
         return True
 
+    def _save_index(self, file_path: str, source_hash: str):
+        if self.index is None:
+            return
+        try:
+            faiss.write_index(self.index, file_path + ".faiss")
+            with open(file_path + ".rag.json", "wb") as f:
+                f.write(orjson.dumps({
+                    "source_hash": source_hash,
+                    "documents": self.documents,
+                    "metadata": self.metadata,
+                }))
+        except (OSError, RuntimeError) as e:
+            print(f"Warning: could not save FAISS index: {e}")
+
     def _initialize_index(self):
         """Create FAISS index from loaded documents."""
         if not self.documents:
             return
 
-        embeddings = self.model.encode(self.documents)
+        embeddings = self._embed_documents()
         dimension = embeddings.shape[1]
 
-        self.index = faiss.IndexFlatL2(dimension)
-        self.index.add(np.array(embeddings).astype("float32"))
+        # Inner product on L2-normalised vectors = cosine similarity.
+        # Large catalogs use an HNSW graph (sub-linear search, approximate);
+        # small ones keep a brute-force scan, which is faster at that size.
+        # Queries stay float32 and are scored against the decoded int8 vectors.
+        if len(self.documents) >= HNSW_MIN_DOCUMENTS:
+            self.index = faiss.IndexHNSWSQ(dimension, INDEX_QTYPE, 32, faiss.METRIC_INNER_PRODUCT)
+            self.index.hnsw.efConstruction = 80
+        else:
+            self.index = faiss.IndexScalarQuantizer(dimension, INDEX_QTYPE, faiss.METRIC_INNER_PRODUCT)
+        self.index.train(embeddings)
+        self.index.add(embeddings)
+        self._query_cache.clear()
         print("FAISS index initialized.")
 
+    def _embed_documents(self) -> np.ndarray:
+        """
+        Embeds self.documents, reusing vectors of unchanged rows from the on-disk
+        embedding cache, so only new or edited rows go through the model.
+        """
+        keys = [
+            hashlib.sha1(f"{self.embedding_id}\0{text}".encode("utf-8")).hexdigest()
+            for text in self.documents
+        ]
+        cache = self._load_embedding_cache()
+
+        missing = list(dict.fromkeys(k for k in keys if k not in cache))
+        if missing:
+            text_by_key = dict(zip(keys, self.documents))
+            vectors = self.model.encode(
+                [text_by_key[k] for k in missing],
+                batch_size=128,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            )
+            cache.update(zip(missing, vectors.astype("float32", copy=False)))
+
+        embeddings = np.stack([cache[k] for k in keys])
+        if missing:
+            self._save_embedding_cache(keys, embeddings)
+        return embeddings
+
+    def _load_embedding_cache(self) -> Dict[str, np.ndarray]:
+        if not self.embedding_cache_path or not os.path.exists(self.embedding_cache_path):
+            return {}
+        try:
+            with np.load(self.embedding_cache_path) as data:
+                return dict(zip(data["keys"].tolist(), data["vectors"]))
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def _save_embedding_cache(self, keys: List[str], embeddings: np.ndarray):
+        """Stores the vectors of the current documents only, so the cache never outgrows the catalog."""
+        if not self.embedding_cache_path:
+            return
+        try:
+            with open(self.embedding_cache_path, "wb") as f:
+                np.savez(f, keys=np.array(keys), vectors=embeddings)
+        except OSError as e:
+            print(f"Warning: could not save embedding cache: {e}")
+
     def query(self, text: str, top_k: int = 3) -> List[Dict[str, Any]]:
         """
         Query the RAG system for relevant documents.
         """
-        if self.index is None or not text:
-            return []
+        return self.query_batch([text], top_k)[0]
 
-        query_embedding = self.model.encode([text])
-        distances, indices = self.index.search(
-            np.array(query_embedding).astype("float32"), top_k
-        )
+    def query_batch(self, texts: List[str], top_k: int = 3) -> List[List[Dict[str, Any]]]:
+        """
+        Query several texts at once: uncached ones share one encode call and
+        one FAISS search. Returns one result list per text, in order.
+        """
+        hits_per_text: List[tuple] = [()] * len(texts)
+        if self.index is None:
+            return [[] for _ in texts]
+
+        pending: Dict[tuple, List[int]] = {}
+        for pos, text in enumerate(texts):
+            if not text:
+                continue
+            key = (text, top_k)
+            cached = self._query_cache.get(key)
+            if cached is not None:
+                self._query_cache.move_to_end(key)
+                hits_per_text[pos] = cached
+            else:
+                pending.setdefault(key, []).append(pos)
+
+        if pending:
+            if isinstance(self.index, faiss.IndexHNSW):
+                self.index.hnsw.efSearch = max(32, top_k)
+
+            query_embeddings = self.model.encode(
+                [text for text, _ in pending],
+                batch_size=64,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+            )
+            distances, indices = self.index.search(
+                query_embeddings.astype("float32", copy=False), top_k
+            )
 
-        results = []
-        for i, idx in enumerate(indices[0]):
-            if idx < len(self.metadata):
-                results.append(self.metadata[idx])
+            for (key, positions), row in zip(pending.items(), indices):
+                # FAISS pads missing hits with -1
+                hits = tuple(int(idx) for idx in row if 0 <= idx < len(self.metadata))
+                self._query_cache[key] = hits
+                for pos in positions:
+                    hits_per_text[pos] = hits
+            while len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
 
-        return results
+        return [[self.metadata[idx] for idx in hits] for hits in hits_per_text]
 
     def get_context_string(self, query_text: str, top_k: int = 3) -> str:
         """
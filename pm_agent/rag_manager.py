@@ -4,6 +4,7 @@ Uses FAISS for fast vector search and multilingual-e5-large for embeddings.
 All operations are offline (local_files_only=True).
 """
 
+import logging
 import os
 from typing import List, Dict, Any
 
@@ -11,6 +12,10 @@ import faiss
 import numpy as np
 from sentence_transformers import SentenceTransformer
 
+# Built on a background thread while the user answers prompts, so progress goes to
+# DEBUG logging instead of stdout; main reports the outcome once the chat starts
+logger = logging.getLogger(__name__)
+
 
 class RAGManager:
     def __init__(self, docs_dir: str, model_path: str):
@@ -23,13 +28,16 @@ class RAGManager:
         self.model_path = model_path
         self.documents: List[Dict[str, str]] = []  # [{title, content, path}]
         self.index: faiss.IndexFlatIP = None  # FAISS inner-product index (cosine sim on normalized vectors)
+        # Query embeddings of the current chat turn: the router cache and retrieval
+        # embed the same user question, so it goes through the model once
+        self._turn_cache: Dict[str, np.ndarray] = {}
 
-        print(f"Loading RAG Embedding Model from {model_path} (offline)...")
+        logger.debug("Loading RAG Embedding Model from %s (offline)...", model_path)
         try:
             self.model = SentenceTransformer(model_path, local_files_only=True)
             self._build_index()
         except Exception as e:
-            print(f"Error loading RAG model: {e}")
+            logger.debug("Error loading RAG model: %s", e)
             self.model = None
 
     # ------------------------------------------------------------------
@@ -39,7 +47,7 @@ class RAGManager:
     def _build_index(self):
         """Reads all .md files, encodes them and builds a FAISS index."""
         if not os.path.exists(self.docs_dir):
-            print(f"Docs directory not found: {self.docs_dir}")
+            logger.debug("Docs directory not found: %s", self.docs_dir)
             return
 
         self.documents = []
@@ -63,20 +71,24 @@ class RAGManager:
                     # For embedding we prepend the title so the vector captures the topic
                     texts_for_embedding.append(f"{title}\n{content}")
                 except Exception as e:
-                    print(f"Error reading {file}: {e}")
+                    logger.debug("Error reading %s: %s", file, e)
 
         if not texts_for_embedding or not self.model:
-            print("No documents indexed.")
+            logger.debug("No documents indexed.")
             return
 
-        print(f"Indexing {len(texts_for_embedding)} documents with FAISS...")
-        embeddings = self.model.encode(texts_for_embedding, normalize_embeddings=True)
-        embeddings = np.array(embeddings, dtype="float32")
+        logger.debug("Indexing %d documents with FAISS...", len(texts_for_embedding))
+        embeddings = self.model.encode(
+            texts_for_embedding, normalize_embeddings=True, convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        # No-op when encode() already returned contiguous float32 (the usual case)
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
 
         dim = embeddings.shape[1]
         self.index = faiss.IndexFlatIP(dim)  # Inner product on L2-normalised = cosine sim
         self.index.add(embeddings)
-        print(f"RAG index built: {self.index.ntotal} vectors, dim={dim}.")
+        logger.debug("RAG index built: %d vectors, dim=%d.", self.index.ntotal, dim)
 
     # ------------------------------------------------------------------
     #  Retrieval
@@ -90,8 +102,7 @@ class RAGManager:
         if not self.is_ready():
             return []
 
-        query_vec = self.model.encode([query], normalize_embeddings=True)
-        query_vec = np.array(query_vec, dtype="float32")
+        query_vec = self.embed_query(query)[None, :]
 
         scores, idxs = self.index.search(query_vec, min(top_k, len(self.documents)))
 
@@ -120,6 +131,19 @@ class RAGManager:
     #  Helpers
     # ------------------------------------------------------------------
 
+    def embed_query(self, text: str) -> np.ndarray:
+        """Normalised float32 embedding of *text*, cached until clear_turn_cache()."""
+        vec = self._turn_cache.get(text)
+        if vec is None:
+            vec = self.model.encode([text], normalize_embeddings=True, convert_to_numpy=True)
+            vec = np.ascontiguousarray(vec[0], dtype=np.float32)
+            self._turn_cache[text] = vec
+        return vec
+
+    def clear_turn_cache(self):
+        """Called at the start of every chat turn."""
+        self._turn_cache.clear()
+
     def is_ready(self) -> bool:
         return self.model is not None and self.index is not None
 
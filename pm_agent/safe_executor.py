@@ -5,34 +5,166 @@ Executes user-generated pandas code in a sandboxed environment.
 
 import ast
 import builtins
-import signal
-import sys
+import ctypes
+import threading
+import weakref
+from collections import OrderedDict
+from types import CodeType, MappingProxyType
 from typing import Any, Dict
 
+import matplotlib
 import numpy as np
 import pandas as pd
+
+# Select the non-interactive backend before pyplot is imported,
+# so no GUI toolkit is ever loaded for server-side plotting
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
-# Set non-interactive backend for server-side plotting
-plt.switch_backend('Agg')
+class TimeoutError(Exception):
+    pass
 
 
-class TimeoutError(Exception):
+def _exec_with_timeout(code_obj: CodeType, globals_: dict, locals_: dict, timeout_seconds: int):
+    """
+    Runs code_obj in a worker thread and waits at most timeout_seconds (works on every
+    platform, unlike SIGALRM). On timeout TimeoutError is injected into the worker, which
+    raises it at its next bytecode boundary; a long single C call (e.g. one huge pandas
+    operation) finishes first, as it did with the alarm signal.
+    """
+    outcome = {}
+
+    def run():
+        try:
+            exec(code_obj, globals_, locals_)
+        except BaseException as e:
+            outcome["error"] = e
+
+    # A fresh daemon thread per call: a runaway snippet can never block later
+    # executions or interpreter exit
+    worker = threading.Thread(target=run, name="autopm-sandbox", daemon=True)
+    worker.start()
+    worker.join(timeout_seconds)
+    if worker.is_alive():
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(
+            ctypes.c_ulong(worker.ident), ctypes.py_object(TimeoutError)
+        )
+        raise TimeoutError(f"Code execution timed out ({timeout_seconds} seconds)")
+    if "error" in outcome:
+        raise outcome["error"]
+
+
+# Top-level modules generated code may import (e.g. "import numpy as np")
+ALLOWED_IMPORTS = frozenset({
+    "pandas", "numpy", "matplotlib", "math", "datetime",
+    "collections", "statistics", "itertools", "re",
+})
+
+
+def _restricted_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level != 0 or name.partition(".")[0] not in ALLOWED_IMPORTS:
+        raise ImportError(f"Импорт модуля '{name}' запрещён в песочнице")
+    return builtins.__import__(name, globals, locals, fromlist, level)
+
+
+# Built once at import. Each execution gets a shallow dict copy (CPython's import
+# opcode requires a real dict), so a snippet cannot rebind a builtin for later ones
+RESTRICTED_BUILTINS = MappingProxyType({
+    "__import__": _restricted_import,
+    "len": len,
+    "sum": sum,
+    "min": min,
+    "max": max,
+    "round": round,
+    "sorted": sorted,
+    "list": list,
+    "dict": dict,
+    "str": str,
+    "int": int,
+    "float": float,
+    "bool": bool,
+    "tuple": tuple,
+    "set": set,
+    "abs": abs,
+    "range": range,
+    "enumerate": enumerate,
+    "zip": zip,
+    "any": any,
+    "all": all,
+    "print": lambda *args, **kwargs: None,  # Disable print
+})
+
+
+# Compiled code objects keyed by source, so retries and repeated questions
+# that produce the same snippet skip parsing and compilation
+_CODE_CACHE: "OrderedDict[str, CodeType]" = OrderedDict()
+_CODE_CACHE_MAX = 256
+
+
+def _compile_cached(code: str, tree: ast.Module = None) -> CodeType:
+    code_obj = _CODE_CACHE.get(code)
+    if code_obj is None:
+        # Compiling the tree from validate_code_syntax skips a second parse of the source
+        code_obj = compile(tree if tree is not None else code, "<agent_code>", "exec")
+        _CODE_CACHE[code] = code_obj
+        if len(_CODE_CACHE) > _CODE_CACHE_MAX:
+            _CODE_CACHE.popitem(last=False)
+    else:
+        _CODE_CACHE.move_to_end(code)
+    return code_obj
+
+
+# Names that would escape the sandbox; they are missing from RESTRICTED_BUILTINS
+# anyway, so code using them can only fail at runtime
+DENIED_NAMES = frozenset({
+    "exec", "eval", "open", "compile", "__import__", "__builtins__",
+    "globals", "locals", "vars", "getattr", "setattr", "delattr",
+})
+
+
+class _DeniedCode(Exception):
     pass
 
 
-def timeout_handler(signum, frame):
-    raise TimeoutError("Code execution timed out (5 seconds)")
+class _Denier(ast.NodeVisitor):
+    """Rejects imports outside ALLOWED_IMPORTS, dunder attributes and DENIED_NAMES."""
+
+    def _check_module(self, name: str):
+        if name.partition(".")[0] not in ALLOWED_IMPORTS:
+            raise _DeniedCode(f"Импорт модуля '{name}' запрещён в песочнице")
+
+    def visit_Import(self, node: ast.Import):
+        for alias in node.names:
+            self._check_module(alias.name)
+
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        if node.level:
+            raise _DeniedCode("Относительный импорт запрещён в песочнице")
+        self._check_module(node.module)
+
+    def visit_Attribute(self, node: ast.Attribute):
+        # __class__, __subclasses__, __globals__ etc. lead from any object to builtins
+        if node.attr.startswith("__") and node.attr.endswith("__"):
+            raise _DeniedCode(f"Обращение к атрибуту '{node.attr}' запрещено (строка {node.lineno})")
+        self.generic_visit(node)
+
+    def visit_Name(self, node: ast.Name):
+        if node.id in DENIED_NAMES:
+            raise _DeniedCode(f"Функция '{node.id}' недоступна в песочнице (строка {node.lineno})")
 
 
 def validate_code_syntax(code: str) -> Dict[str, Any]:
     """
-    Checks code for syntax errors without executing it.
-    Returns {"success": True} or {"success": False, "error": "..."}.
+    Checks code for syntax errors and denied constructs (see _Denier) without executing it.
+    Returns {"success": True, "tree": ast.Module} or {"success": False, "error": "..."};
+    pass the tree on to execute_pandas_code so the code is parsed only once.
     """
     try:
-        ast.parse(code)
-        return {"success": True}
+        tree = ast.parse(code)
+        _Denier().visit(tree)
+        return {"success": True, "tree": tree}
+    except _DeniedCode as e:
+        return {"success": False, "error": f"Запрещённая конструкция: {e}"}
     except SyntaxError as e:
         return {
             "success": False,
@@ -42,8 +174,81 @@ def validate_code_syntax(code: str) -> Dict[str, Any]:
         return {"success": False, "error": f"Ошибка валидации: {e}"}
 
 
+# Method calls known to return a new object instead of writing into the caller's arrays
+_READ_ONLY_METHODS = frozenset({
+    "groupby", "agg", "aggregate", "apply", "map", "transform", "filter", "pipe",
+    "count", "nunique", "unique", "value_counts", "size", "describe", "mode",
+    "idxmax", "idxmin", "nlargest", "nsmallest", "rank", "cumcount", "pct_change",
+    "head", "tail", "sample", "first", "last", "sort_values", "sort_index",
+    "reset_index", "set_index", "rename", "drop", "dropna", "fillna", "astype", "copy",
+    "merge", "join", "pivot", "pivot_table", "melt", "stack", "unstack", "explode",
+    "drop_duplicates", "duplicated", "isin", "isna", "notna", "isnull", "notnull",
+    "between", "shift", "diff", "where", "mask", "query", "assign", "replace",
+    "resample", "rolling", "expanding", "corr", "cov", "to_frame", "to_dict",
+    "to_list", "tolist", "to_numpy", "to_period", "to_timestamp", "total_seconds",
+    "strftime", "normalize", "tz_localize", "tz_convert", "contains", "startswith",
+    "endswith", "lower", "upper", "strip", "split", "len", "get", "items", "keys",
+    "values", "format", "append", "argsort", "array", "asarray", "arange",
+    "plot", "bar", "barh", "hist", "line", "pie", "scatter", "box",
+})
+# Names that are also numpy functions or ndarray methods taking out as their second or
+# third positional argument (e.g. a.round(2, out), np.sum(a, 0, None, out)):
+# read-only only when called with at most one positional argument
+_OUT_ARG_METHODS = frozenset({
+    "sum", "mean", "median", "min", "max", "std", "var", "prod", "quantile", "percentile",
+    "cumsum", "cumprod", "cummax", "cummin", "round", "abs", "clip", "any", "all",
+    "floor", "ceil", "log", "exp", "sqrt", "isnan", "take",
+})
+# np.<name> references allowed in read-only code; anything else (np.random.shuffle,
+# np.copyto, ufuncs passed as callbacks) may write into df's arrays
+_NUMPY_READ_ONLY = (_READ_ONLY_METHODS | _OUT_ARG_METHODS | frozenset({
+    "nan", "inf", "int64", "float64", "datetime64", "timedelta64", "select",
+})) - {"apply", "pipe", "map"}
+# Safe builtins from RESTRICTED_BUILTINS that never mutate their arguments
+_READ_ONLY_BUILTINS = frozenset(RESTRICTED_BUILTINS) - {"__import__"}
+
+
+def _is_read_only(tree: ast.Module) -> bool:
+    """
+    True only if every write target and call in the code is on the allowlists above,
+    so it cannot write into the arrays of df. Anything unrecognised counts as a write.
+    """
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.AugAssign, ast.Delete)):
+            return False
+        if isinstance(node, (ast.Subscript, ast.Attribute)) and not isinstance(node.ctx, ast.Load):
+            return False
+        if (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name)
+                and node.value.id == "np" and node.attr not in _NUMPY_READ_ONLY):
+            return False
+        if not isinstance(node, ast.Call):
+            continue
+        for kw in node.keywords:
+            if kw.arg is None or kw.arg == "out" or (
+                kw.arg == "inplace"
+                and not (isinstance(kw.value, ast.Constant) and kw.value.value is False)
+            ):
+                return False
+        func = node.func
+        if isinstance(func, ast.Name):
+            if func.id not in _READ_ONLY_BUILTINS:
+                return False
+        elif isinstance(func, ast.Attribute):
+            module = func.value.id if isinstance(func.value, ast.Name) else None
+            if module == "plt" or (module == "pd" and func.attr != "eval"):
+                continue
+            if func.attr in _OUT_ARG_METHODS:
+                if len(node.args) > 1 or any(isinstance(a, ast.Starred) for a in node.args):
+                    return False
+            elif func.attr not in _READ_ONLY_METHODS:
+                return False
+        else:
+            return False
+    return True
+
+
 def execute_pandas_code(
-    code: str, df: pd.DataFrame, timeout_seconds: int = 5
+    code: str, df: pd.DataFrame, timeout_seconds: int = 5, tree: ast.Module = None
 ) -> Dict[str, Any]:
     """
     Executes pandas code in a restricted namespace.
@@ -51,65 +256,45 @@ def execute_pandas_code(
     Security measures:
     - Only df, pd, np available
     - __builtins__ blocked (no open, exec, eval, import)
-    - Execution on df.copy() to prevent mutations
+    - Execution on a copy of df to prevent mutations (shallow for provably read-only code)
     - Timeout to prevent infinite loops
     - Result size limit (10KB)
 
+    tree is the AST of code from validate_code_syntax, if already parsed.
+
     Returns:
         {"success": True, "result": ..., "result_type": "..."} or
         {"success": False, "error": "..."}
     """
-    # Create safe namespace
-    safe_df = df.copy()
-    
-    # Define restricted builtins
-    restricted_builtins = {
-        "__import__": builtins.__import__,
-        "len": len,
-        "sum": sum,
-        "min": min,
-        "max": max,
-        "round": round,
-        "sorted": sorted,
-        "list": list,
-        "dict": dict,
-        "str": str,
-        "int": int,
-        "float": float,
-        "bool": bool,
-        "tuple": tuple,
-        "set": set,
-        "abs": abs,
-        "range": range,
-        "enumerate": enumerate,
-        "zip": zip,
-        "any": any,
-        "all": all,
-        "print": lambda *args, **kwargs: None,  # Disable print
-    }
+    if tree is None:
+        try:
+            tree = ast.parse(code)
+        except SyntaxError:
+            pass  # reported by _run_sandboxed
+    # Code proven read-only (the usual groupby/filter/plot) gets a shallow copy sharing
+    # df's arrays instead of a copy of the whole log. Everything else gets a private
+    # deep copy, so inplace=True, .values writes etc. behave exactly as before
+    deep = tree is None or not _is_read_only(tree)
+    safe_df = df.copy(deep=deep)
+    return _run_sandboxed(code, safe_df, timeout_seconds, tree)
+
 
+def _run_sandboxed(
+    code: str, safe_df: pd.DataFrame, timeout_seconds: int, tree: ast.Module = None
+) -> Dict[str, Any]:
     allowed_globals = {
         "df": safe_df,
         "pd": pd,
         "np": np,
         "plt": plt,
-        "__builtins__": restricted_builtins,
+        "__builtins__": dict(RESTRICTED_BUILTINS),
     }
 
     local_vars = {}
 
     try:
-        # Set timeout (Unix only, skip on Windows)
-        if sys.platform != "win32":
-            signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(timeout_seconds)
-
-        # Execute code
-        exec(code, allowed_globals, local_vars)
-
-        # Cancel timeout
-        if sys.platform != "win32":
-            signal.alarm(0)
+        # Execute code (with timeout)
+        _exec_with_timeout(_compile_cached(code, tree), allowed_globals, local_vars, timeout_seconds)
 
         # Get result
         if "result" not in local_vars:
@@ -147,16 +332,19 @@ def execute_pandas_code(
     except Exception as e:
         return {"success": False, "error": f"{type(e).__name__}: {e}"}
     finally:
-        if sys.platform != "win32":
-            signal.alarm(0)
+        # Release figures created by the generated code (already saved to disk),
+        # otherwise they pile up in pyplot's registry across chat turns
+        plt.close('all')
 
 
 def format_result(result: Any) -> str:
     """Formats result for display."""
     if isinstance(result, pd.DataFrame):
+        # Cap rendered columns and cell width: to_string cost grows with both
         if len(result) > 20:
-            return f"DataFrame ({len(result)} строк, {len(result.columns)} колонок):\n{result.head(10).to_string()}\n... (показаны первые 10)"
-        return result.to_string()
+            text = result.head(10).to_string(max_cols=20, max_colwidth=40)
+            return f"DataFrame ({len(result)} строк, {len(result.columns)} колонок):\n{text}\n... (показаны первые 10)"
+        return result.to_string(max_cols=20, max_colwidth=40)
     elif isinstance(result, pd.Series):
         if len(result) > 20:
             return f"Series ({len(result)} элементов):\n{result.head(10).to_string()}\n... (показаны первые 10)"
@@ -170,17 +358,50 @@ def format_result(result: Any) -> str:
         return str(result)
 
 
-def get_df_info_for_llm(df: pd.DataFrame) -> str:
-    """Generates a detailed DataFrame description for LLM context (Profiling)."""
+# Profiling text per live DataFrame: id(df) -> (weakref, fingerprint, info).
+# Entries are dropped by the weakref callback once the DataFrame is collected.
+_df_info_cache: Dict[int, tuple] = {}
+
+
+def _df_fingerprint(df: pd.DataFrame, full_describe: bool) -> tuple:
+    """Cheap guard against id reuse and shape/column changes (not in-place value edits)."""
+    edges = tuple(df.index[[0, -1]]) if len(df) else ()
+    return (df.shape, tuple(df.columns), edges, full_describe)
+
+
+def get_df_info_for_llm(df: pd.DataFrame, full_describe: bool = False) -> str:
+    """Generates a detailed DataFrame description for LLM context (Profiling).
+
+    By default describe() only covers the columns listed below (first 15);
+    pass full_describe=True to profile every column of a wide frame.
+    Results are memoized per DataFrame object.
+    """
+    key = id(df)
+    fingerprint = _df_fingerprint(df, full_describe)
+    cached = _df_info_cache.get(key)
+    if cached is not None and cached[0]() is df and cached[1] == fingerprint:
+        return cached[2]
+
+    info = _build_df_info(df, full_describe)
+    try:
+        ref = weakref.ref(df, lambda _, k=key: _df_info_cache.pop(k, None))
+    except TypeError:
+        return info
+    _df_info_cache[key] = (ref, fingerprint, info)
+    return info
+
+
+def _build_df_info(df: pd.DataFrame, full_describe: bool) -> str:
+    described = df if full_describe else df[df.columns[:15]]
     info_lines = [
         f"DataFrame: {len(df)} строк, {len(df.columns)} колонок",
         f"Первые 3 строки (head):\n{df.head(3).to_string()}\n",
-        "Статистика (describe):\n" + (df.describe().to_string() if not df.empty else "N/A") + "\n",
+        "Статистика (describe):\n" + (described.describe().to_string() if not df.empty else "N/A") + "\n",
         "Типы данных и примеры значений:",
     ]
 
-    for col in df.columns[:15]:
-        dtype = str(df[col].dtype)
+    # Read all dtypes in one pass instead of per-column Series lookups
+    for col, dtype in df.dtypes.iloc[:15].astype(str).items():
         
         # Get unique values / frequency for core columns
         if dtype in ['object', 'category']:
@@ -188,7 +409,9 @@ def get_df_info_for_llm(df: pd.DataFrame) -> str:
             counts_str = ", ".join([f"'{k}': {v}" for k, v in vc.items()])
             info_lines.append(f"  - {col}: {dtype} (Частые: {counts_str})")
         else:
-            sample = str(df[col].dropna().iloc[0]) if len(df[col].dropna()) > 0 else "N/A"
+            # Position of the first non-NA value (no dropna() copy of the column)
+            valid = df[col].notna().to_numpy()
+            sample = str(df[col].iloc[valid.argmax()]) if valid.any() else "N/A"
             info_lines.append(f"  - {col}: {dtype} (пример: {sample})")
 
     if len(df.columns) > 15: